@@ -8,18 +8,24 @@ LangGraph智能问答Agent - 多智能体版本
 - 子智能体2：DataAnalysisAgent（数据分析）
 
 支持长短期记忆：
-- 短期记忆：MemorySaver（会话内对话历史）
+- 短期记忆：SqliteSaver / MemorySaver（会话内对话历史）
 - 长期记忆：LongTermMemory（跨会话用户偏好和知识）
 """
 
 import os
 import uuid
-from typing import Dict, Any
+from functools import lru_cache
+from typing import Dict, Any, Optional, Iterator
 
 from langchain_community.llms import Tongyi
 from langchain_core.language_models import BaseLLM
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # 未编译libyaml时使用纯Python解析器
+    from yaml import SafeLoader
+
 from agents import MasterAgent
 
 from rich.console import Console
@@ -29,6 +35,42 @@ from rich.prompt import Prompt
 console = Console()
 
 
+@lru_cache(maxsize=None)
+def _load_config_file(config_path: str) -> Dict[str, Any]:
+    """解析配置文件（按路径缓存，多个系统实例共享同一份配置）"""
+    with open(config_path, 'r', encoding='utf-8') as f:
+        raw = f.read()
+    config = yaml.load(raw, Loader=SafeLoader)
+    
+    # 没有 ${...} 占位符时无需遍历配置树
+    if "${" not in raw:
+        return config
+    
+    # 替换环境变量
+    def replace_env_vars(obj):
+        if isinstance(obj, dict):
+            return {k: replace_env_vars(v) for k, v in obj.items()}
+        if isinstance(obj, str) and obj.startswith("${") and obj.endswith("}"):
+            return os.getenv(obj[2:-1], obj)
+        return obj
+    
+    return replace_env_vars(config)
+
+
+@lru_cache(maxsize=None)
+def _create_llm(provider: str, model: str, temperature: float, max_tokens: int, api_key: str) -> BaseLLM:
+    """创建语言模型客户端（相同配置在进程内共享同一个实例）"""
+    if provider == "dashscope":
+        # Tongyi 没有 temperature/max_tokens 字段，直接传入会被忽略，需通过 model_kwargs 传给接口
+        return Tongyi(
+            model=model,
+            model_kwargs={"temperature": temperature, "max_tokens": max_tokens},
+            dashscope_api_key=api_key
+        )
+    else:
+        raise ValueError(f"Unsupported LLM provider: {provider}")
+
+
 class MultiAgentSystem:
     """多智能体系统 - 主入口类"""
     
@@ -40,12 +82,14 @@ class MultiAgentSystem:
         """
         self.config = self._load_config(config_path)
         self.llm = self._init_llm()
+        self.intent_llm = self._init_llm(self.config["llm"].get("intent_model"))
         self.db_path = self.config["database"]["path"]
         
         # 记忆配置
         memory_config = self.config.get("memory", {})
         memory_db_path = memory_config.get("long_term_db", "./data/long_term_memory.db")
         short_term_max_tokens = memory_config.get("short_term_max_tokens", 1000)
+        checkpoint_db_path = memory_config.get("checkpoint_db")
         
         # 初始化主智能体（内部会初始化两个子智能体）
         self.master_agent = MasterAgent(
@@ -53,7 +97,11 @@ class MultiAgentSystem:
             db_path=self.db_path,
             num_examples=self.config["nl2sql"]["num_examples"],
             memory_db_path=memory_db_path,
-            short_term_max_tokens=short_term_max_tokens
+            short_term_max_tokens=short_term_max_tokens,
+            checkpoint_db_path=checkpoint_db_path,
+            cache_config=self.config.get("cache", {}),
+            intent_llm=self.intent_llm,
+            use_mcp=self.config["database"].get("use_mcp", False)
         )
         
         # 用户登录状态
@@ -62,32 +110,27 @@ class MultiAgentSystem:
     
     def _load_config(self, config_path: str) -> Dict[str, Any]:
         """加载配置文件"""
-        with open(config_path, 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
-        
-        # 替换环境变量
-        def replace_env_vars(obj):
-            if isinstance(obj, dict):
-                return {k: replace_env_vars(v) for k, v in obj.items()}
-            if isinstance(obj, str) and obj.startswith("${") and obj.endswith("}"):
-                return os.getenv(obj[2:-1], obj)
-            return obj
-        
-        return replace_env_vars(config)
+        return _load_config_file(config_path)
     
-    def _init_llm(self) -> BaseLLM:
-        """初始化语言模型"""
+    def _init_llm(self, model: Optional[str] = None) -> BaseLLM:
+        """初始化语言模型
+        
+        Args:
+            model: 模型名称，默认使用配置中的主模型
+        """
         llm_config = self.config["llm"]
         
-        if llm_config["provider"] == "dashscope":
-            return Tongyi(
-                model=llm_config["model"],
-                temperature=llm_config["temperature"],
-                max_tokens=llm_config["max_tokens"],
-                dashscope_api_key=llm_config["api_key"]
-            )
-        else:
-            raise ValueError(f"Unsupported LLM provider: {llm_config['provider']}")
+        return _create_llm(
+            llm_config["provider"],
+            model or llm_config["model"],
+            llm_config["temperature"],
+            llm_config["max_tokens"],
+            llm_config["api_key"]
+        )
+    
+    def close(self):
+        """释放主智能体持有的线程池、数据库连接等资源"""
+        self.master_agent.close()
     
     def login(self, user_id: str) -> bool:
         """用户登录
@@ -131,6 +174,27 @@ class MultiAgentSystem:
             user_id=self.user_id
         )
     
+    def query_stream(self, question: str) -> Iterator[str]:
+        """执行查询并流式返回回答
+        
+        Args:
+            question: 用户问题
+        
+        Yields:
+            回答文本片段
+        """
+        if not self.user_id:
+            yield "请先登录。您可以输入任意用户ID开始使用。"
+            return
+        
+        thread_id = f"{self.user_id}_{self.session_id}"
+        
+        yield from self.master_agent.query_stream(
+            question,
+            thread_id=thread_id,
+            user_id=self.user_id
+        )
+    
     def set_thread_id(self, thread_id: str):
         """设置会话线程ID（保留兼容性）
         
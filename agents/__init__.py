@@ -2,11 +2,22 @@
 智能体模块
 
 包含主智能体和子智能体的实现。
+子智能体按需导入（PEP 562），避免只用到其中一个时加载全部依赖。
 """
 
-from .master_agent import MasterAgent
-from .sql_agent import SQLQueryAgent
-from .analysis_agent import DataAnalysisAgent
+import importlib
+
+_AGENT_MODULES = {
+    'MasterAgent': '.master_agent',
+    'SQLQueryAgent': '.sql_agent',
+    'DataAnalysisAgent': '.analysis_agent',
+}
 
 __all__ = ['MasterAgent', 'SQLQueryAgent', 'DataAnalysisAgent']
 
+
+def __getattr__(name):
+    if name in _AGENT_MODULES:
+        module = importlib.import_module(_AGENT_MODULES[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
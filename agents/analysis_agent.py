@@ -4,15 +4,25 @@
 负责对查询结果进行深度分析，生成洞察和建议。
 """
 
-import json
+from functools import lru_cache
 from typing import Dict, Any, Optional
-from pathlib import Path
 
+import numpy as np
+import orjson
 from langchain_core.language_models import BaseLLM
 
-import sys
-sys.path.append(str(Path(__file__).parent.parent))
 from prompts import get_analysis_prompt
+from llm_cache import cached_invoke
+
+
+# 超过该长度的数据不进入解析缓存，避免缓存常驻大对象
+_PARSE_CACHE_MAX_SIZE = 1024 * 1024
+
+
+@lru_cache(maxsize=128)
+def _parse_json_cached(data_str: str) -> Any:
+    """按内容缓存JSON解析结果（调用方不得修改返回的对象）"""
+    return orjson.loads(data_str)
 
 
 class DataAnalysisAgent:
@@ -22,12 +32,19 @@ class DataAnalysisAgent:
         self.llm = llm
     
     def _parse_data(self, data_str: str) -> Optional[Any]:
-        """解析数据字符串"""
+        """解析数据字符串（同一结果被多次分析时复用解析结果）"""
         try:
-            return json.loads(data_str)
+            if isinstance(data_str, str) and len(data_str) <= _PARSE_CACHE_MAX_SIZE:
+                return _parse_json_cached(data_str)
+            return orjson.loads(data_str)
         except:
             return None
     
+    @staticmethod
+    def _format_number(value: float) -> str:
+        """格式化统计值，整数值不显示小数部分"""
+        return str(int(value)) if float(value).is_integer() else str(float(value))
+    
     def _prepare_data_summary(self, data: Any) -> str:
         """准备数据摘要
         
@@ -41,13 +58,15 @@ class DataAnalysisAgent:
             if len(data) == 0:
                 return "数据为空"
             
-            summary = f"数据总数: {len(data)}条记录\n"
+            # 逐行收集后一次性拼接，避免大结果集下反复拼接字符串
+            lines = [f"数据总数: {len(data)}条记录"]
             
             # 显示前几条数据
             if len(data) > 0:
-                summary += f"数据示例:\n"
-                for i, item in enumerate(data[:3]):
-                    summary += f"  记录{i+1}: {json.dumps(item, ensure_ascii=False)}\n"
+                lines.append("数据示例:")
+                lines.extend(
+                    f"  记录{i+1}: {orjson.dumps(item).decode()}" for i, item in enumerate(data[:3])
+                )
             
             # 如果有数值字段，计算统计信息
             if len(data) > 0 and isinstance(data[0], dict):
@@ -57,28 +76,44 @@ class DataAnalysisAgent:
                         numeric_fields.append(key)
                 
                 if numeric_fields:
-                    summary += "\n数值字段统计:\n"
-                    for field in numeric_fields:
-                        values = [item[field] for item in data if field in item and isinstance(item[field], (int, float))]
-                        if values:
-                            summary += f"  {field}:\n"
-                            summary += f"    - 最小值: {min(values)}\n"
-                            summary += f"    - 最大值: {max(values)}\n"
-                            summary += f"    - 平均值: {sum(values)/len(values):.2f}\n"
+                    lines.append("\n数值字段统计:")
+                    # 一次遍历构建数值矩阵（缺失或非数值记为NaN），按列向量化统计
+                    matrix = np.array(
+                        [
+                            [
+                                value if isinstance(value := item.get(field), (int, float)) else np.nan
+                                for field in numeric_fields
+                            ]
+                            for item in data
+                        ],
+                        dtype=np.float64
+                    )
+                    valid = ~np.all(np.isnan(matrix), axis=0)
+                    columns = matrix[:, valid]
+                    mins = np.nanmin(columns, axis=0)
+                    maxs = np.nanmax(columns, axis=0)
+                    means = np.nanmean(columns, axis=0)
+                    
+                    fields = [field for field, ok in zip(numeric_fields, valid) if ok]
+                    for field, min_v, max_v, mean_v in zip(fields, mins, maxs, means):
+                        lines.append(f"  {field}:")
+                        lines.append(f"    - 最小值: {self._format_number(min_v)}")
+                        lines.append(f"    - 最大值: {self._format_number(max_v)}")
+                        lines.append(f"    - 平均值: {mean_v:.2f}")
             
-            return summary
+            return "\n".join(lines) + "\n"
         
         elif isinstance(data, dict):
-            return f"单条记录: {json.dumps(data, ensure_ascii=False)}"
+            return f"单条记录: {orjson.dumps(data).decode()}"
         
         else:
             return str(data)
     
-    def analyze(self, data: str, context: str = "") -> Dict[str, Any]:
+    def analyze(self, data: Any, context: str = "") -> Dict[str, Any]:
         """分析数据
         
         Args:
-            data: JSON格式的数据字符串
+            data: SQL智能体返回的结构化数据，也兼容JSON格式的数据字符串
             context: 上下文信息（如原始问题）
             
         Returns:
@@ -90,8 +125,8 @@ class DataAnalysisAgent:
         }
         
         try:
-            # 解析数据
-            parsed_data = self._parse_data(data)
+            # 解析数据（已是结构化数据时直接使用）
+            parsed_data = self._parse_data(data) if isinstance(data, str) else data
             
             if parsed_data is None:
                 result["error"] = "无法解析数据"
@@ -113,7 +148,7 @@ class DataAnalysisAgent:
             )
             
             # 调用LLM进行分析
-            analysis = self.llm.invoke(prompt)
+            analysis = cached_invoke(self.llm, prompt)
             result["analysis"] = analysis
             
         except Exception as e:
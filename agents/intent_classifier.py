@@ -0,0 +1,109 @@
+"""
+本地意图分类器
+
+用句向量匹配标注好的示例问题，在本地完成意图识别，置信度不足时交给LLM判断。
+"""
+
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from agents.semantic_cache import HAS_EMBEDDER, _encode_text
+
+# 各意图的示例问题（与意图识别提示词中的四个类别对应）
+INTENT_EXAMPLES: Dict[str, List[str]] = {
+    "sql_only": [
+        "公司一共有多少名员工",
+        "研发部有哪些员工",
+        "列出所有部门的名称",
+        "薪资最高的员工是谁",
+        "查询张三的入职时间",
+        "各部门的平均工资是多少",
+        "市场部经理是谁",
+        "2021年以后入职的员工有哪些",
+    ],
+    "sql_and_analysis": [
+        "分析各部门的薪资水平",
+        "对比研发部和市场部的人员结构",
+        "找出高薪员工并分析他们的特点",
+        "分析公司员工的入职趋势",
+        "评估各部门的绩效差异",
+        "分析不同职位的薪资分布",
+    ],
+    "analysis_only": [
+        "分析一下刚才查询的数据",
+        "对上面的结果做个总结",
+        "根据之前的数据给出建议",
+        "上一次查询的结果有什么特点",
+        "解读一下刚刚的查询结果",
+    ],
+    "simple_answer": [
+        "你好",
+        "谢谢你的帮助",
+        "你能做什么",
+        "你是谁",
+        "再见",
+        "怎么使用这个系统",
+    ],
+}
+
+
+class EmbeddingIntentClassifier:
+    """基于示例问题相似度的意图分类器
+    
+    对每个意图取与问题最相似的示例得分，最高分达到阈值且明显高于次高分时返回该意图，
+    否则返回None交给LLM判断。未安装 sentence-transformers 时始终返回None。
+    """
+    
+    def __init__(self, threshold: float = 0.8, margin: float = 0.05,
+                model_name: str = "paraphrase-multilingual-MiniLM-L12-v2"):
+        """初始化意图分类器
+        
+        Args:
+            threshold: 最高相似度阈值
+            margin: 最高分与次高分的最小差距
+            model_name: 句向量模型名称（与语义缓存共用同一模型）
+        """
+        self.threshold = threshold
+        self.margin = margin
+        self.model_name = model_name if HAS_EMBEDDER else None
+        self._intents = list(INTENT_EXAMPLES)
+        self._example_matrices: Optional[List[np.ndarray]] = None
+        self._lock = threading.Lock()
+    
+    def _get_example_matrices(self) -> List[np.ndarray]:
+        """计算各意图示例问题的句向量矩阵（首次使用时计算）"""
+        if self._example_matrices is None:
+            with self._lock:
+                if self._example_matrices is None:
+                    self._example_matrices = [
+                        np.stack([_encode_text(self.model_name, text) for text in INTENT_EXAMPLES[intent]])
+                        for intent in self._intents
+                    ]
+        return self._example_matrices
+    
+    def classify(self, question: str) -> Optional[str]:
+        """识别问题意图
+        
+        Args:
+            question: 用户问题
+        
+        Returns:
+            意图类型，置信度不足或模型不可用时返回None
+        """
+        if self.model_name is None:
+            return None
+        
+        try:
+            query_vec = _encode_text(self.model_name, question)
+            scores = np.array([float(np.max(matrix @ query_vec)) for matrix in self._get_example_matrices()])
+        except Exception as e:
+            print(f"本地意图分类失败: {e}")
+            return None
+        
+        order = np.argsort(scores)[::-1]
+        best, second = scores[order[0]], scores[order[1]]
+        if best < self.threshold or best - second < self.margin:
+            return None
+        return self._intents[order[0]]
@@ -4,21 +4,38 @@
 负责意图识别、任务路由、协调子智能体和结果汇总。
 """
 
-from typing import TypedDict, Sequence, Dict, Any, Optional, Annotated
+import atexit
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TypedDict, Sequence, Dict, Any, Optional, Annotated, Iterator
 from pathlib import Path
 
+import orjson
+from cachetools import TTLCache
+
+from langgraph.config import get_stream_writer
 from langgraph.graph import StateGraph, END, add_messages
 from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.sqlite import SqliteSaver
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
 from langchain_core.language_models import BaseLLM
 
-import sys
-sys.path.append(str(Path(__file__).parent.parent))
 from prompts import get_master_intent_prompt, get_summary_prompt
+from token_counter import count_tokens
 from agents.sql_agent import SQLQueryAgent
 from agents.analysis_agent import DataAnalysisAgent
+from agents.semantic_cache import SemanticCache
+from agents.intent_classifier import EmbeddingIntentClassifier
 from memory.long_term_memory import LongTermMemory
 from memory.memory_extractor import MemoryExtractor
+from memory.formatting import format_conversation, format_conversation_tail
 
 
 class MasterAgentState(TypedDict):
@@ -31,14 +48,136 @@ class MasterAgentState(TypedDict):
     final_answer: Optional[str]
     error: Optional[str]
     metadata: Dict[str, Any]
+    history_summary: Optional[Dict[str, Any]]  # 滚动摘要 {"upto": 已总结的消息条数, "summary": 摘要文本}
+
+
+# 意图识别规则（按顺序匹配），命中即跳过LLM；未命中的问题仍交给LLM判断
+_ANALYSIS_WORDS = r"分析|对比|比较|特点|特征|趋势|洞察|建议|差异|异常|评估|解读"
+_PREVIOUS_DATA_WORDS = r"刚才|刚刚|上一次|上次|之前|前面|上面|以上"
+GREETING_PATTERN = re.compile(
+    r"^(你好|您好|嗨|谢谢|多谢|感谢|再见|拜拜|帮助|hi|hello|help|thanks|bye)[\s!！。.,，~～?？]*$", re.I
+)
+INTENT_RULES = [
+    (GREETING_PATTERN, "simple_answer"),
+    (re.compile(rf"^(?=.*(?:{_ANALYSIS_WORDS}|总结))(?=.*(?:{_PREVIOUS_DATA_WORDS}))"), "analysis_only"),
+    (re.compile(_ANALYSIS_WORDS), "sql_and_analysis"),
+    (re.compile(r"多少|几个|几名|几人|哪些|哪个|哪位|列出|查询|查一下|是谁|有谁|最高|最低|平均|总共|总数"), "sql_only"),
+]
+
+
+# 简单问题的固定回复，关键词编译为一个正则，单次扫描完成匹配
+COMMON_RESPONSES = {
+    "你好": "你好！我是智能数据查询助手，可以帮你查询员工、部门、薪资等信息，还可以进行数据分析。有什么可以帮你的吗？",
+    "谢谢": "不客气！还有什么其他问题吗？",
+    "再见": "再见！祝你工作顺利！",
+    "帮助": "我可以帮你：\n1. 查询数据库信息（如：有多少员工？）\n2. 分析数据（如：分析各部门薪资水平）\n3. 综合查询和分析（如：找出高薪员工并分析特征）",
+}
+# 同义词映射到同一条回复，与关键词一起编译进正则，词表扩充后仍是单次扫描
+COMMON_RESPONSE_ALIASES = {
+    "您好": "你好", "嗨": "你好", "hello": "你好", "hi": "你好",
+    "多谢": "谢谢", "感谢": "谢谢", "thanks": "谢谢",
+    "拜拜": "再见", "bye": "再见",
+    "help": "帮助",
+}
+COMMON_RESPONSE_PATTERN = re.compile(
+    "|".join(
+        # 英文词需完整匹配，避免 "this" 中的 "hi" 被当作问候
+        rf"(?<![a-z]){re.escape(word)}(?![a-z])" if word.isascii() else re.escape(word)
+        for word in sorted([*COMMON_RESPONSES, *COMMON_RESPONSE_ALIASES], key=len, reverse=True)
+    ),
+    re.I
+)
+
+
+# 意图精确缓存：SHA256(prompt) -> intent，按持久化路径在进程内共享（各用户的主智能体共用一份），
+# 进程退出时由模块级钩子统一写回，不持有任何主智能体的引用
+_intent_caches: Dict[str, "OrderedDict[str, str]"] = {}
+_intent_cache_lock = threading.Lock()
+
+
+def _load_intent_cache(path: str) -> "OrderedDict[str, str]":
+    """从磁盘加载意图缓存"""
+    cache = OrderedDict()
+    if Path(path).exists():
+        try:
+            with open(path, 'rb') as f:
+                cache.update(orjson.loads(f.read()))
+        except Exception as e:
+            print(f"加载意图缓存失败: {e}")
+    return cache
+
+
+def _get_intent_cache(path: Optional[str]) -> "OrderedDict[str, str]":
+    """获取路径对应的共享意图缓存（首次使用时从磁盘加载），未配置路径时返回不持久化的独立缓存"""
+    if not path:
+        return OrderedDict()
+    with _intent_cache_lock:
+        if path not in _intent_caches:
+            _intent_caches[path] = _load_intent_cache(path)
+        return _intent_caches[path]
+
+
+def _save_intent_caches():
+    """将所有意图缓存持久化到磁盘（先写临时文件再替换，避免写到一半的文件）"""
+    with _intent_cache_lock:
+        snapshots = [(path, orjson.dumps(cache)) for path, cache in _intent_caches.items() if cache]
+    
+    for path, data in snapshots:
+        tmp_path = None
+        try:
+            directory = Path(path).parent
+            directory.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False, suffix=".tmp") as f:
+                tmp_path = f.name
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"保存意图缓存失败: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+atexit.register(_save_intent_caches)
+
+
+class AnswerStreamError(RuntimeError):
+    """流式生成回答中途失败（调用方已收到部分片段），异常信息为错误说明"""
+
+
+@dataclass(slots=True)
+class CachedAnswer:
+    """语义缓存中保存的回答"""
+    answer: str
+    intent: str
+    sql_result: Optional[Dict[str, Any]]
 
 
 class MasterAgent:
     """主智能体 - 协调SQL查询和数据分析子智能体"""
     
+    # sql_only结果不超过该行数时直接格式化输出，不再调用LLM汇总
+    DIRECT_ANSWER_MAX_ROWS = 20
+    
+    # 只缓存结果相对稳定的意图，分析类回答依赖上下文，不缓存
+    CACHEABLE_INTENTS = ("simple_answer", "sql_only")
+    
+    # 会话数据最多保留的thread数量及有效期（秒）
+    SESSION_MAX_THREADS = 1000
+    SESSION_TTL = 3600
+    
+    # 压缩对话历史时保留的最近原始消息条数
+    HISTORY_TAIL_MESSAGES = 10
+    
+    # 长期记忆上下文缓存的最大条数
+    CONTEXT_CACHE_SIZE = 256
+    
     def __init__(self, llm: BaseLLM, db_path: str, num_examples: int = 3, 
                 memory_db_path: str = "./data/long_term_memory.db",
-                short_term_max_tokens: int = 1000):
+                short_term_max_tokens: int = 1000,
+                checkpoint_db_path: Optional[str] = None,
+                cache_config: Optional[Dict[str, Any]] = None,
+                intent_llm: Optional[BaseLLM] = None,
+                use_mcp: bool = False):
         """初始化主智能体
         
         Args:
@@ -47,30 +186,140 @@ class MasterAgent:
             num_examples: Few-shot示例数量
             memory_db_path: 长期记忆数据库路径
             short_term_max_tokens: 短期记忆最大token数
+            checkpoint_db_path: 短期记忆checkpoint数据库路径，为空时保存在进程内存中
+            cache_config: 缓存配置（enabled、similarity_threshold、max_entries、ttl、
+                intent_cache_path、intent_cache_size）
+            intent_llm: 意图识别专用的语言模型（可使用更小更快的模型），默认与llm相同
+            use_mcp: SQL是否通过MCP服务执行，默认在进程内直接查询
         """
         self.llm = llm
+        self.intent_llm = intent_llm or llm
         self.db_path = db_path
         self.short_term_max_tokens = short_term_max_tokens
         
+        # 初始化语义缓存：最终回答按用户隔离，生成的SQL与用户无关，两者使用独立的缓存
+        cache_config = cache_config or {}
+        self.semantic_cache = None
+        sql_cache = None
+        if cache_config.get("enabled", True):
+            # 回答缓存按句向量匹配，并要求部门、员工、职位等实体一致；
+            # SQL缓存只复用规范化后完全相同的问题，避免只差一个实体的问题复用错误的SQL
+            self.semantic_cache = self._create_semantic_cache(cache_config, entities=self._load_entity_aliases(db_path))
+            sql_cache = self._create_semantic_cache(cache_config, model_name=None)
+        
         # 初始化子智能体
-        self.sql_agent = SQLQueryAgent(llm, db_path, num_examples)
+        self.sql_agent = SQLQueryAgent(llm, db_path, num_examples, sql_cache=sql_cache, use_mcp=use_mcp)
         self.analysis_agent = DataAnalysisAgent(llm)
         
-        # 初始化短期记忆（MemorySaver）
-        self.memory = MemorySaver()
+        # 初始化短期记忆（配置了数据库路径时使用SqliteSaver持久化，否则使用MemorySaver）
+        self.memory = self._init_checkpointer(checkpoint_db_path)
         
         # 初始化长期记忆（LongTermMemory）
         self.long_term_memory = LongTermMemory(memory_db_path)
         
+        # 长期记忆上下文缓存：(user_id, question) -> (记忆版本号, 格式化文本)，记忆写入后版本号变化即失效
+        self._context_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._context_lock = threading.Lock()
+        
         # 初始化记忆提取器
         self.memory_extractor = MemoryExtractor(llm)
         
-        # 会话数据存储：保存每个thread_id的最近查询结果
-        self.session_data = {}
+        # 会话数据存储：保存每个thread_id的最近查询结果（限制容量并按TTL过期）
+        self.session_data = TTLCache(maxsize=self.SESSION_MAX_THREADS, ttl=self.SESSION_TTL)
+        
+        # 本地意图分类器：规则未命中时先用句向量匹配示例问题，置信度不足再调用LLM
+        self.intent_classifier = EmbeddingIntentClassifier()
+        
+        # 意图精确缓存：同一路径的缓存在进程内共享，LRU淘汰并在退出时持久化
+        self.intent_cache_size = cache_config.get("intent_cache_size", 10000)
+        self.intent_cache_path = cache_config.get("intent_cache_path", "./data/intent_cache.json")
+        self._intent_cache: "OrderedDict[str, str]" = _get_intent_cache(self.intent_cache_path)
+        
+        # 线程池：并发执行互不依赖的I/O和LLM调用
+        self._executor = ThreadPoolExecutor(max_workers=4)
+        
+        # 记忆提取线程池：单线程按提交顺序执行，进程退出时会等待已提交的任务完成
+        self._memory_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-extract")
+        # 等待提取的对话：user_id -> 最新的消息列表，同一用户最多排队一个任务，新对话覆盖旧对话
+        self._pending_extractions: Dict[str, Sequence[BaseMessage]] = {}
+        self._pending_lock = threading.Lock()
         
         # 构建工作流
         self.graph = self._build_graph()
     
+    def close(self):
+        """释放资源：等待后台任务完成后关闭线程池、数据库连接和MCP会话，清空缓存"""
+        self._executor.shutdown(wait=True)
+        # 等待已提交的记忆提取写完再关闭长期记忆连接
+        self._memory_executor.shutdown(wait=True)
+        
+        self.sql_agent.close()
+        self.long_term_memory.close()
+        if isinstance(self.memory, SqliteSaver):
+            self.memory.conn.close()
+        
+        if self.semantic_cache:
+            self.semantic_cache.clear()
+        if self.sql_agent.sql_cache:
+            self.sql_agent.sql_cache.clear()
+    
+    @staticmethod
+    def _create_semantic_cache(cache_config: Dict[str, Any], **kwargs: Any) -> SemanticCache:
+        """根据缓存配置创建语义缓存（kwargs透传给SemanticCache，如model_name、entities）"""
+        return SemanticCache(
+            threshold=cache_config.get("similarity_threshold", 0.92),
+            max_entries=cache_config.get("max_entries", 1000),
+            ttl=cache_config.get("ttl", 600),
+            **kwargs
+        )
+    
+    @staticmethod
+    def _load_entity_aliases(db_path: str) -> Dict[str, str]:
+        """从业务数据库读取部门名、员工姓名和职位，作为语义缓存必须一致的实体
+        
+        Args:
+            db_path: 业务数据库路径
+        
+        Returns:
+            实体别名 -> 规范名（部门名额外登记去掉"部"字的简称）
+        """
+        aliases: Dict[str, str] = {}
+        try:
+            conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+            try:
+                for (dept_name,) in conn.execute("SELECT dept_name FROM departments"):
+                    aliases[dept_name] = dept_name
+                    if dept_name.endswith("部") and len(dept_name) > 2:
+                        aliases.setdefault(dept_name[:-1], dept_name)
+                for (name,) in conn.execute(
+                    "SELECT emp_name FROM employees UNION SELECT position FROM employees WHERE position IS NOT NULL"
+                ):
+                    aliases.setdefault(name, name)
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"加载缓存实体失败: {e}")
+        return aliases
+    
+    def _init_checkpointer(self, checkpoint_db_path: Optional[str]):
+        """初始化短期记忆checkpointer
+        
+        Args:
+            checkpoint_db_path: checkpoint数据库路径
+            
+        Returns:
+            checkpointer实例
+        """
+        if not checkpoint_db_path:
+            return MemorySaver()
+        
+        Path(checkpoint_db_path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(checkpoint_db_path, check_same_thread=False)
+        # WAL模式下读写互不阻塞，synchronous=NORMAL 减少每次提交的fsync
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return SqliteSaver(conn)
+    
     def _build_graph(self) -> StateGraph:
         """构建LangGraph状态图"""
         workflow = StateGraph(MasterAgentState)
@@ -105,7 +354,7 @@ class MasterAgent:
         workflow.add_edge("call_both", "summarize")
         workflow.add_edge("summarize", END)
         
-        # 使用MemorySaver作为checkpointer
+        # 使用短期记忆作为checkpointer
         return workflow.compile(checkpointer=self.memory)
     
     def _get_conversation_history(self, state: MasterAgentState) -> str:
@@ -114,7 +363,10 @@ class MasterAgent:
         策略：
         1. 如果消息少于等于10条，直接返回所有
         2. 如果消息较多但token未超限，返回近期消息
-        3. 如果消息很多且超过token限制，使用LLM总结压缩
+        3. 如果消息很多且超过token限制，早期消息合并进滚动摘要，只保留最近的原始消息
+        
+        滚动摘要保存在状态中随checkpoint持久化，每轮只把新移出窗口的消息交给LLM续写摘要，
+        不再重复总结整个历史。
         
         Args:
             state: 当前状态
@@ -127,51 +379,54 @@ class MasterAgent:
             return ""
         
         # 构建原始历史（排除当前消息）
-        history_text = self._format_messages(messages[:-1])
+        history = messages[:-1]
+        history_text = format_conversation(history)
         
         # 如果消息数量少，直接返回
         if len(messages) <= 11:  # 10条历史消息
             return history_text
         
-        # 简单token估算（中文按2字符=1token，英文按4字符=1token）
-        estimated_tokens = len(history_text) / 2.5
-        
-        if estimated_tokens <= self.short_term_max_tokens:
+        if count_tokens(history_text) <= self.short_term_max_tokens:
             return history_text
         
-        # 需要压缩：使用LLM总结
-        return self._compress_history_with_llm(history_text)
-    
-    def _format_messages(self, messages: Sequence[BaseMessage]) -> str:
-        """格式化消息列表为文本
-        
-        Args:
-            messages: 消息列表
-            
-        Returns:
-            格式化的文本
-        """
-        history = []
-        for msg in messages:
-            if isinstance(msg, HumanMessage):
-                history.append(f"用户: {msg.content}")
-            elif isinstance(msg, AIMessage):
-                history.append(f"助手: {msg.content}")
-        
-        return "\n".join(history) if history else ""
+        # 需要压缩：窗口之前的消息并入滚动摘要
+        split = len(history) - self.HISTORY_TAIL_MESSAGES
+        history_summary = state.get("history_summary") or {}
+        summarized_upto = history_summary.get("upto", 0)
+        summary = history_summary.get("summary", "")
+        if summarized_upto > split:
+            summarized_upto, summary = 0, ""
+        
+        if split > summarized_upto:
+            new_summary = self._compress_history_with_llm(
+                format_conversation(history[summarized_upto:split]), summary
+            )
+            if new_summary is None:
+                # 如果压缩失败，返回最近的部分对话
+                return format_conversation_tail(history, 20)
+            summary = new_summary
+            state["history_summary"] = {"upto": split, "summary": summary}
+        
+        recent_text = format_conversation(history[split:])
+        return f"[对话历史总结]\n{summary}\n\n[最近对话]\n{recent_text}"
     
-    def _compress_history_with_llm(self, history_text: str) -> str:
+    def _compress_history_with_llm(self, history_text: str, previous_summary: str = "") -> Optional[str]:
         """使用LLM总结压缩对话历史
         
         Args:
-            history_text: 原始对话历史文本
+            history_text: 需要并入摘要的对话历史文本
+            previous_summary: 已有的滚动摘要，为空时从头总结
             
         Returns:
-            压缩后的摘要文本
+            压缩后的摘要文本，失败时返回None
         """
+        previous_section = ""
+        if previous_summary:
+            previous_section = f"已有的对话总结：\n{previous_summary}\n\n请在此基础上补充以下新对话，输出更新后的完整总结：\n\n"
+        
         prompt = f"""请总结以下对话历史，保留关键信息、用户偏好和重要上下文：
 
-{history_text}
+{previous_section}{history_text}
 
 总结要求：
 1. 保留关键事实和数据（如查询的部门、员工、数据结果）
@@ -183,14 +438,10 @@ class MasterAgent:
 总结："""
         
         try:
-            summary = self.llm.invoke(prompt).strip()
-            return f"[对话历史总结]\n{summary}"
+            return self.llm.invoke(prompt).strip()
         except Exception as e:
             print(f"压缩对话历史失败: {e}")
-            # 如果压缩失败，返回最近的部分对话
-            lines = history_text.split("\n")
-            recent_lines = lines[-20:] if len(lines) > 20 else lines
-            return "\n".join(recent_lines)
+            return None
     
     def _format_long_term_context(
         self, 
@@ -225,39 +476,99 @@ class MasterAgent:
         question = state["user_question"]
         user_id = state["metadata"].get("user_id")
         
+        # 规则快速路径：意图明显的问题无需构建上下文和调用LLM
+        for pattern, rule_intent in INTENT_RULES:
+            if pattern.search(question):
+                state["intent"] = rule_intent
+                state["metadata"]["intent_response"] = "[rule]"
+                return state
+        
+        # 本地分类快速路径：与示例问题高度相似时直接确定意图；
+        # 依赖上文的追问（如"那产品部呢"）与示例差距较大，会继续交给LLM结合对话历史判断
+        local_intent = self.intent_classifier.classify(question)
+        if local_intent:
+            state["intent"] = local_intent
+            state["metadata"]["intent_response"] = "[local]"
+            return state
+        
+        # 同一用户重复提问且长期记忆未更新时，直接复用上次格式化的上下文
+        context_key = (user_id, question)
+        context_version = self.long_term_memory.get_version(user_id) if user_id else None
+        with self._context_lock:
+            cached_context = self._context_cache.get(context_key)
+            context_hit = cached_context is not None and cached_context[0] == context_version
+            if context_hit:
+                self._context_cache.move_to_end(context_key)
+        
+        # 长期记忆读取与短期记忆整理（可能触发LLM压缩）互不依赖：
+        # 先在线程池中发起长期记忆查询，再在当前线程整理对话历史，最后汇合结果
+        if user_id and not context_hit:
+            context_future = self._executor.submit(self.long_term_memory.load_context, user_id, question, 3)
+        
         # 获取对话历史（短期记忆）
         conversation_history = self._get_conversation_history(state)
         
         # 获取用户知识（长期记忆）
         user_context = ""
-        if user_id:
+        if context_hit:
+            user_context = cached_context[1]
+        elif user_id:
             try:
-                knowledge = self.long_term_memory.get_relevant_knowledge(user_id, question, top_k=3)
-                preferences = self.long_term_memory.get_all_preferences(user_id)
-                user_context = self._format_long_term_context(knowledge, preferences)
+                long_term_context = context_future.result()
+                user_context = self._format_long_term_context(
+                    long_term_context["knowledge"], long_term_context["preferences"]
+                )
+                with self._context_lock:
+                    self._context_cache[context_key] = (context_version, user_context)
+                    self._context_cache.move_to_end(context_key)
+                    while len(self._context_cache) > self.CONTEXT_CACHE_SIZE:
+                        self._context_cache.popitem(last=False)
             except Exception as e:
                 print(f"获取长期记忆失败: {e}")
         
         prompt = get_master_intent_prompt(question, conversation_history, user_context)
         
+        # 意图识别的prompt是确定性的，相同prompt直接复用缓存结果
+        cache_key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        with _intent_cache_lock:
+            cached_intent = self._intent_cache.get(cache_key)
+            if cached_intent is not None:
+                self._intent_cache.move_to_end(cache_key)
+        if cached_intent is not None:
+            state["intent"] = cached_intent
+            state["metadata"]["intent_response"] = "[cache]"
+            return state
+        
         try:
-            response = self.llm.invoke(prompt).strip()
+            # 要求模型以JSON模式输出，保证一次调用即可得到合法意图
+            response = self.intent_llm.invoke(prompt, response_format={"type": "json_object"}).strip()
             
-            # 清理响应，提取意图
-            intent = response.lower().strip()
+            # 解析结构化输出，提取意图
+            try:
+                intent = str(orjson.loads(response).get("intent", "")).lower().strip()
+            except (orjson.JSONDecodeError, AttributeError):
+                intent = ""
             
             # 验证意图是否有效
             valid_intents = ["simple_answer", "sql_only", "analysis_only", "sql_and_analysis"]
             if intent not in valid_intents:
-                # 如果LLM返回的不是有效选项，尝试从响应中提取
+                # 如果LLM返回的不是有效JSON或选项，尝试从原始响应中提取
                 for valid_intent in valid_intents:
-                    if valid_intent in intent:
+                    if valid_intent in response.lower():
                         intent = valid_intent
                         break
                 else:
                     # 默认为sql_only
                     intent = "sql_only"
             
+            # 只缓存LLM明确给出的意图，兜底结果不缓存
+            if intent in response.lower():
+                with _intent_cache_lock:
+                    self._intent_cache[cache_key] = intent
+                    self._intent_cache.move_to_end(cache_key)
+                    while len(self._intent_cache) > self.intent_cache_size:
+                        self._intent_cache.popitem(last=False)
+            
             state["intent"] = intent
             state["metadata"]["intent_response"] = response
             
@@ -273,33 +584,33 @@ class MasterAgent:
     
     def _simple_answer_node(self, state: MasterAgentState) -> MasterAgentState:
         """简单回答节点"""
-        question = state["user_question"]
-        
-        common_responses = {
-            "你好": "你好！我是智能数据查询助手，可以帮你查询员工、部门、薪资等信息，还可以进行数据分析。有什么可以帮你的吗？",
-            "谢谢": "不客气！还有什么其他问题吗？",
-            "再见": "再见！祝你工作顺利！",
-            "帮助": "我可以帮你：\n1. 查询数据库信息（如：有多少员工？）\n2. 分析数据（如：分析各部门薪资水平）\n3. 综合查询和分析（如：找出高薪员工并分析特征）",
-        }
-        
-        # 检查常见问候
-        answer = None
-        for key, response in common_responses.items():
-            if key in question:
-                answer = response
-                break
-        
-        # 默认回复
-        if not answer:
-            answer = "我是智能数据查询助手。请问有什么关于员工、部门或薪资的问题需要我帮忙吗？"
+        answer = self._simple_answer(state["user_question"])
         
         state["final_answer"] = answer
         
-        # 将AI回答添加到messages中
-        state["messages"] = state["messages"] + [AIMessage(content=answer)]
+        # 将AI回答添加到messages中（只返回增量，由add_messages归并器追加，避免每轮复制整个消息列表）
+        state["messages"] = [AIMessage(content=answer)]
         
         return state
     
+    def _simple_answer(self, question: str) -> str:
+        """生成问候、感谢等简单问题的固定回复
+        
+        Args:
+            question: 用户问题
+            
+        Returns:
+            回复文本
+        """
+        # 单次扫描匹配常见问候关键词
+        match = COMMON_RESPONSE_PATTERN.search(question)
+        if match:
+            key = match.group().lower()
+            return COMMON_RESPONSES[COMMON_RESPONSE_ALIASES.get(key, key)]
+        
+        # 默认回复
+        return "我是智能数据查询助手。请问有什么关于员工、部门或薪资的问题需要我帮忙吗？"
+    
     def _call_sql_node(self, state: MasterAgentState) -> MasterAgentState:
         """调用SQL查询子智能体"""
         question = state["user_question"]
@@ -311,9 +622,7 @@ class MasterAgent:
             state["metadata"]["sql_result"] = result
             
             # 保存到会话数据存储
-            if thread_id not in self.session_data:
-                self.session_data[thread_id] = {}
-            self.session_data[thread_id]["last_sql_result"] = result
+            self._save_last_sql_result(thread_id, result)
             
         except Exception as e:
             state["error"] = f"SQL查询失败: {str(e)}"
@@ -321,6 +630,17 @@ class MasterAgent:
         
         return state
     
+    def _save_last_sql_result(self, thread_id: str, result: Dict[str, Any]):
+        """保存最近一次查询结果（重新写入条目以刷新TTL）
+        
+        Args:
+            thread_id: 线程ID
+            result: SQL查询结果
+        """
+        session = dict(self.session_data.get(thread_id, {}))
+        session["last_sql_result"] = result
+        self.session_data[thread_id] = session
+    
     def _call_analysis_node(self, state: MasterAgentState) -> MasterAgentState:
         """调用数据分析子智能体"""
         question = state["user_question"]
@@ -333,8 +653,8 @@ class MasterAgent:
         if state.get("sql_result") and "data" in state["sql_result"]:
             data_to_analyze = state["sql_result"]["data"]
         # 否则从会话数据存储中获取历史查询结果
-        elif thread_id in self.session_data and "last_sql_result" in self.session_data[thread_id]:
-            last_sql_result = self.session_data[thread_id]["last_sql_result"]
+        else:
+            last_sql_result = self.session_data.get(thread_id, {}).get("last_sql_result")
             if last_sql_result and "data" in last_sql_result:
                 data_to_analyze = last_sql_result["data"]
         
@@ -365,9 +685,7 @@ class MasterAgent:
             state["metadata"]["sql_result"] = sql_result
             
             # 保存到会话数据存储
-            if thread_id not in self.session_data:
-                self.session_data[thread_id] = {}
-            self.session_data[thread_id]["last_sql_result"] = sql_result
+            self._save_last_sql_result(thread_id, sql_result)
             
             # 检查SQL查询是否成功
             if sql_result.get("error"):
@@ -390,6 +708,39 @@ class MasterAgent:
         
         return state
     
+    def _format_direct_answer(self, rows: Any) -> Optional[str]:
+        """将小结果集直接格式化为Markdown回答
+        
+        Args:
+            rows: SQL智能体返回的结构化查询结果
+            
+        Returns:
+            格式化的回答，结果不适合直接展示时返回None
+        """        
+        if isinstance(rows, dict) and "message" in rows:
+            return rows["message"]
+        
+        if not isinstance(rows, list) or not rows or len(rows) > self.DIRECT_ANSWER_MAX_ROWS:
+            return None
+        if not all(isinstance(row, dict) for row in rows):
+            return None
+        
+        columns = list(rows[0].keys())
+        
+        # 单值结果直接用一句话回答
+        if len(rows) == 1 and len(columns) == 1:
+            return f"查询结果：{columns[0]} = {rows[0][columns[0]]}"
+        
+        lines = [
+            "| " + " | ".join(columns) + " |",
+            "| " + " | ".join("---" for _ in columns) + " |"
+        ]
+        for row in rows:
+            cells = ["" if row.get(col) is None else str(row.get(col)) for col in columns]
+            lines.append("| " + " | ".join(cells) + " |")
+        
+        return f"查询到 {len(rows)} 条记录：\n\n" + "\n".join(lines)
+    
     def _summarize_node(self, state: MasterAgentState) -> MasterAgentState:
         """汇总结果节点"""
         question = state["user_question"]
@@ -419,6 +770,14 @@ class MasterAgent:
                 return state
             analysis_data = analysis_result.get("analysis")
         
+        # 仅查询且结果较小时，数据本身就是答案，直接格式化输出，跳过LLM汇总
+        if state.get("intent") == "sql_only" and sql_data and not analysis_data:
+            direct_answer = self._format_direct_answer(sql_data)
+            if direct_answer:
+                state["final_answer"] = direct_answer
+                state["messages"] = [AIMessage(content=direct_answer)]
+                return state
+        
         # 使用LLM生成自然语言汇总
         try:
             prompt = get_summary_prompt(
@@ -427,13 +786,20 @@ class MasterAgent:
                 analysis_result=analysis_data
             )
             
-            answer = self.llm.invoke(prompt)
+            # 流式生成：每段输出通过stream writer推送给query_stream的调用方（graph.invoke时写入被忽略）
+            writer = get_stream_writer()
+            parts = []
+            for chunk in self.llm.stream(prompt):
+                parts.append(chunk)
+                writer(chunk)
+            answer = "".join(parts)
             state["final_answer"] = answer
             
-            # 将AI回答添加到messages中，这样会被checkpointer保存
-            state["messages"] = state["messages"] + [AIMessage(content=answer)]
+            # 将AI回答添加到messages中，这样会被checkpointer保存（增量由add_messages归并器追加）
+            state["messages"] = [AIMessage(content=answer)]
             
         except Exception as e:
+            state["error"] = str(e)
             state["final_answer"] = f"生成回答时出错：{str(e)}"
         
         return state
@@ -449,6 +815,43 @@ class MasterAgent:
         Returns:
             回答结果
         """
+        try:
+            return "".join(self.query_stream(question, thread_id=thread_id, user_id=user_id))
+        except AnswerStreamError as e:
+            return str(e)
+    
+    def query_stream(self, question: str, thread_id: str = "default",
+                     user_id: Optional[str] = None) -> Iterator[str]:
+        """执行查询并流式返回回答
+        
+        需要LLM汇总的回答按生成进度逐段返回；直接格式化、缓存命中等回答一次性返回。
+        
+        Args:
+            question: 用户问题
+            thread_id: 线程ID，用于区分不同的会话
+            user_id: 用户ID，用于长期记忆
+            
+        Yields:
+            回答文本片段，拼接后即完整回答
+        
+        Raises:
+            AnswerStreamError: 汇总回答已输出部分片段后生成失败
+        """
+        # 纯问候语无需上下文，直接回复，不进入工作流也不写入短期记忆
+        if GREETING_PATTERN.search(question):
+            yield self._simple_answer(question)
+            return
+        
+        # 使用checkpointer保存会话状态
+        config = {"configurable": {"thread_id": thread_id}}
+        
+        # 语义缓存命中时直接返回，跳过整个工作流
+        if self.semantic_cache:
+            cached = self.semantic_cache.get(question, user_id)
+            if cached:
+                yield self._answer_from_cache(question, cached, config, thread_id)
+                return
+        
         initial_state = {
             "messages": [HumanMessage(content=question)],
             "user_question": question,
@@ -463,22 +866,94 @@ class MasterAgent:
             }
         }
         
-        # 使用checkpointer保存会话状态
-        config = {"configurable": {"thread_id": thread_id}}
-        
-        final_state = self.graph.invoke(initial_state, config)
-        
-        answer = final_state.get("final_answer", "抱歉，无法处理你的问题。")
+        # custom模式接收汇总节点推送的片段，values模式取得最终状态
+        final_state = {}
+        streamed = False
+        for mode, chunk in self.graph.stream(initial_state, config, stream_mode=["custom", "values"]):
+            if mode == "custom":
+                streamed = True
+                yield chunk
+            else:
+                final_state = chunk
+        
+        answer = final_state.get("final_answer") or "抱歉，无法处理你的问题。"
+        if not streamed:
+            yield answer
+        
+        intent = final_state.get("intent")
+        sql_result = final_state.get("sql_result")
+        failed = final_state.get("error") or (sql_result and sql_result.get("error"))
+        if self.semantic_cache and not failed and intent in self.CACHEABLE_INTENTS:
+            self.semantic_cache.put(
+                question,
+                CachedAnswer(answer=answer, intent=intent, sql_result=sql_result),
+                user_id
+            )
         
         # 获取完整的对话历史（已经包含了当前的问题和回答）
-        all_messages = list(final_state["messages"])
+        all_messages = list(final_state.get("messages", []))
         
         print(f"[记忆] 当前会话共有 {len(all_messages)} 条消息")
         
-        # 自动提取并保存长期记忆
+        # 自动提取并保存长期记忆（后台执行，不阻塞本轮回答）
         if user_id:
-            self._extract_and_save_memory(all_messages, user_id)
+            self._schedule_memory_extraction(all_messages, user_id)
+        
+        # 已输出部分片段后生成失败：错误信息不能再拼接到回答里，显式抛出让调用方单独提示
+        if streamed and final_state.get("error"):
+            raise AnswerStreamError(answer)
+    
+    def _schedule_memory_extraction(self, messages: Sequence[BaseMessage], user_id: str):
+        """提交后台记忆提取任务
+        
+        同一用户已有任务在排队时只更新待提取的消息（后一轮对话包含前一轮的全部内容），
+        不再重复提交，避免连续提问时提取任务堆积。
         
+        Args:
+            messages: 对话消息列表
+            user_id: 用户ID
+        """
+        with self._pending_lock:
+            already_queued = user_id in self._pending_extractions
+            self._pending_extractions[user_id] = messages
+        if not already_queued:
+            self._memory_executor.submit(self._run_pending_extraction, user_id)
+    
+    def _run_pending_extraction(self, user_id: str):
+        """取出用户最新的待提取对话并执行提取"""
+        with self._pending_lock:
+            messages = self._pending_extractions.pop(user_id, None)
+        if messages is not None:
+            self._extract_and_save_memory(messages, user_id)
+    
+    def _answer_from_cache(self, question: str, cached: CachedAnswer,
+                           config: Dict[str, Any], thread_id: str) -> str:
+        """使用缓存结果回答，并同步短期记忆和会话数据
+        
+        Args:
+            question: 用户问题
+            cached: 缓存的回答
+            config: 工作流配置
+            thread_id: 线程ID
+            
+        Returns:
+            缓存的回答
+        """
+        answer = cached.answer
+        
+        # 将本轮问答写入checkpointer，保持对话历史连贯
+        as_node = "simple_answer" if cached.intent == "simple_answer" else "summarize"
+        self.graph.update_state(
+            config,
+            {"messages": [HumanMessage(content=question), AIMessage(content=answer)]},
+            as_node=as_node
+        )
+        
+        # 恢复最近查询结果，供后续analysis_only使用
+        if cached.sql_result:
+            self._save_last_sql_result(thread_id, cached.sql_result)
+        
+        print("[缓存] 命中语义缓存，跳过工作流")
         return answer
     
     def _extract_and_save_memory(self, messages: Sequence[BaseMessage], user_id: str):
@@ -490,27 +965,28 @@ class MasterAgent:
         """
         try:
             # 只在对话达到一定长度时才提取
-            if not self.memory_extractor.should_extract(messages, threshold=6):
+            if not self.memory_extractor.should_extract(messages, threshold=6, user_id=user_id):
                 return
             
-            # 提取用户偏好
-            preferences = self.memory_extractor.extract_preferences_from_conversation(
-                messages, user_id
-            )
-            for key, value in preferences.items():
-                self.long_term_memory.save_preference(user_id, key, str(value))
+            # 一次LLM调用同时提取用户偏好和知识
+            preferences, knowledge_list = self.memory_extractor.extract_all(messages, user_id)
             
-            # 提取用户知识
-            knowledge_list = self.memory_extractor.extract_knowledge_from_conversation(
-                messages, user_id
+            # 批量写入：偏好和知识各用一个事务
+            self.long_term_memory.save_many_preferences(
+                user_id,
+                {key: str(value) for key, value in preferences.items()}
+            )
+            self.long_term_memory.save_many_knowledge(
+                user_id,
+                [
+                    (
+                        knowledge.get("category", "其他"),
+                        knowledge.get("content", ""),
+                        knowledge.get("confidence", 0.8)
+                    )
+                    for knowledge in knowledge_list
+                ]
             )
-            for knowledge in knowledge_list:
-                self.long_term_memory.save_knowledge(
-                    user_id,
-                    knowledge.get("category", "其他"),
-                    knowledge.get("content", ""),
-                    knowledge.get("confidence", 0.8)
-                )
         except Exception as e:
             print(f"提取记忆失败: {e}")
 
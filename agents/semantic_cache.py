@@ -0,0 +1,176 @@
+"""
+语义缓存
+
+基于句向量余弦相似度复用历史结果，主智能体的最终回答和SQL智能体生成的SQL各自使用独立的缓存实例。
+"""
+
+import importlib.util
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Any, Optional
+
+import numpy as np
+
+# 句向量模型可选：未安装 sentence-transformers 时语义缓存退化为规范化文本的精确匹配
+HAS_EMBEDDER = importlib.util.find_spec("sentence_transformers") is not None
+_embedders: Dict[str, Any] = {}
+_embedder_lock = threading.Lock()
+
+_NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+# 引号中的字面值（如"张三"、'研发部'），必须一致才能复用
+_QUOTED_PATTERN = re.compile(r"[\"'“‘「『]([^\"'”’」』]+)[\"'”’」』]")
+
+
+def _get_embedder(model_name: str):
+    """懒加载句向量模型（进程内单例，首次使用时才导入和加载）"""
+    if model_name not in _embedders:
+        with _embedder_lock:
+            if model_name not in _embedders:
+                from sentence_transformers import SentenceTransformer
+                _embedders[model_name] = SentenceTransformer(model_name)
+    return _embedders[model_name]
+
+
+@lru_cache(maxsize=2048)
+def _encode_text(model_name: str, text: str) -> np.ndarray:
+    """计算归一化句向量（按文本缓存）"""
+    return _get_embedder(model_name).encode(text, normalize_embeddings=True)
+
+
+@dataclass(slots=True)
+class CacheEntry:
+    """语义缓存条目"""
+    embedding: Optional[np.ndarray]
+    signature: tuple
+    value: Any
+    created_at: float
+
+
+class SemanticCache:
+    """语义缓存 - 相似问题直接复用历史结果
+    
+    使用句向量余弦相似度匹配历史问题，未安装 sentence-transformers 或 model_name 为None时只做规范化文本的精确匹配。
+    问题中的数字、引号中的字面值和已知实体（如部门名）必须完全一致才算命中，
+    避免"薪资超过2万"复用"薪资超过3万"、"研发部有多少员工"复用"市场部有多少员工"的结果。
+    """
+    
+    def __init__(self, threshold: float = 0.92, max_entries: int = 1000, ttl: int = 600,
+                model_name: Optional[str] = "paraphrase-multilingual-MiniLM-L12-v2",
+                entities: Optional[Dict[str, str]] = None):
+        """初始化语义缓存
+        
+        Args:
+            threshold: 余弦相似度阈值，达到该值视为命中
+            max_entries: 最大缓存条数，超出后按LRU淘汰
+            ttl: 缓存有效期（秒）
+            model_name: 句向量模型名称，为None时只做精确匹配
+            entities: 已知实体的别名 -> 规范名（如 {"研发": "研发部", "研发部": "研发部"}）
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.model_name = model_name if HAS_EMBEDDER else None
+        self.entities = entities or {}
+        self._entity_pattern = re.compile(
+            "|".join(re.escape(alias) for alias in sorted(self.entities, key=len, reverse=True))
+        ) if self.entities else None
+        
+        # 后台预热模型，避免首次查询承担加载耗时
+        if self.model_name:
+            threading.Thread(target=_get_embedder, args=(self.model_name,), daemon=True).start()
+        self._entries: "OrderedDict[tuple, CacheEntry]" = OrderedDict()
+    
+    @staticmethod
+    def _normalize(question: str) -> str:
+        """规范化问题文本（去除空白和标点、统一小写）"""
+        return re.sub(r"[\s\W_]+", "", question).lower()
+    
+    def _signature(self, question: str) -> tuple:
+        """提取必须完全一致的关键信息：数字、引号中的字面值、已知实体"""
+        entities = ()
+        if self._entity_pattern is not None:
+            entities = tuple(sorted({self.entities[m.group()] for m in self._entity_pattern.finditer(question)}))
+        return (
+            tuple(_NUMBER_PATTERN.findall(question)),
+            tuple(sorted(_QUOTED_PATTERN.findall(question))),
+            entities
+        )
+    
+    def _embed(self, question: str) -> Optional[np.ndarray]:
+        """计算归一化句向量"""
+        if self.model_name is None:
+            return None
+        return _encode_text(self.model_name, question)
+    
+    def _evict_expired(self):
+        """淘汰过期缓存"""
+        now = time.time()
+        expired = [key for key, entry in self._entries.items() if now - entry.created_at > self.ttl]
+        for key in expired:
+            del self._entries[key]
+    
+    def get(self, question: str, namespace: Optional[str] = None) -> Optional[Any]:
+        """查找相似问题的缓存结果
+        
+        Args:
+            question: 用户问题
+            namespace: 缓存隔离范围（如用户ID）
+        
+        Returns:
+            缓存的结果，未命中返回None
+        """
+        self._evict_expired()
+        
+        key = (namespace, self._normalize(question))
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key].value
+        
+        query_vec = self._embed(question)
+        if query_vec is None:
+            return None
+        
+        signature = self._signature(question)
+        keys = [
+            k for k, entry in self._entries.items()
+            if k[0] == namespace and entry.embedding is not None and entry.signature == signature
+        ]
+        if not keys:
+            return None
+        
+        matrix = np.stack([self._entries[k].embedding for k in keys])
+        scores = np.dot(matrix, query_vec)
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        
+        self._entries.move_to_end(keys[best])
+        return self._entries[keys[best]].value
+    
+    def put(self, question: str, value: Any, namespace: Optional[str] = None):
+        """写入缓存
+        
+        Args:
+            question: 用户问题
+            value: 要缓存的结果
+            namespace: 缓存隔离范围（如用户ID）
+        """
+        key = (namespace, self._normalize(question))
+        self._entries[key] = CacheEntry(
+            embedding=self._embed(question),
+            signature=self._signature(question),
+            value=value,
+            created_at=time.time()
+        )
+        self._entries.move_to_end(key)
+        
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def clear(self):
+        """清空缓存"""
+        self._entries.clear()
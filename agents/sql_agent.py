@@ -4,38 +4,99 @@ SQL查询子智能体
 负责将自然语言转换为SQL并执行查询。
 """
 
-import json
+import atexit
 import sqlite3
 import sys
 import asyncio
-from typing import Dict, Any
+import re
+import threading
+import weakref
+from concurrent.futures import Future
+from typing import Dict, Any, Optional
 from pathlib import Path
 
+import orjson
 from langchain_core.language_models import BaseLLM
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
-sys.path.append(str(Path(__file__).parent.parent))
 from prompts import get_few_shot_prompt
+from agents.semantic_cache import SemanticCache
+
+# 清理LLM输出：去除首尾的代码块标记和"SQL:"/"sql："前缀，捕获中间的SQL语句
+_SQL_CLEAN_PATTERN = re.compile(r"^\s*(?:```(?:sql)?)?\s*(?:sql[:：])?\s*(.*?)\s*(?:```)?\s*$", re.S | re.I)
+
+# 进程内共享的后台事件循环：所有智能体的MCP会话都运行在这一个循环上
+_background_loop: Optional[asyncio.AbstractEventLoop] = None
+_background_loop_lock = threading.Lock()
+
+
+def _get_background_loop() -> asyncio.AbstractEventLoop:
+    """获取后台事件循环，首次调用时在守护线程中启动"""
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name="mcp-event-loop", daemon=True).start()
+        return _background_loop
+
+
+def _close_if_alive(close_ref: weakref.WeakMethod):
+    """进程退出时关闭仍存活的智能体（弱引用，不阻止已淘汰的智能体被回收）"""
+    close = close_ref()
+    if close is not None:
+        close()
 
 
 class SQLQueryAgent:
     """SQL查询子智能体"""
     
-    def __init__(self, llm: BaseLLM, db_path: str, num_examples: int = 3):
+    # MCP服务启动和单次工具调用的超时时间（秒）
+    MCP_START_TIMEOUT = 30
+    MCP_CALL_TIMEOUT = 60
+    
+    def __init__(self, llm: BaseLLM, db_path: str, num_examples: int = 3,
+                sql_cache: Optional[SemanticCache] = None, use_mcp: bool = False):
         """初始化SQL查询智能体
         
         Args:
             llm: 语言模型实例
             db_path: 数据库路径
             num_examples: Few-shot示例数量
+            sql_cache: SQL语义缓存，相似问题复用已成功执行的SQL，为空时不缓存
+            use_mcp: 是否通过MCP服务执行SQL；默认在进程内直接查询本地SQLite，
+                需要隔离执行或接入其他数据源时启用
         """
         self.llm = llm
         self.db_path = db_path
         self.num_examples = num_examples
+        self.sql_cache = sql_cache
+        self.use_mcp = use_mcp
+        self._schema_text = None
+        
+        # 进程内执行使用的只读连接（跨线程共享，由锁串行化访问）
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_lock = threading.Lock()
+        
+        # 常驻MCP会话：首次执行SQL时在共享的后台事件循环上启动MCP服务进程，之后所有查询复用
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._session: Optional[ClientSession] = None
+        self._session_closed: Optional[asyncio.Event] = None
+        self._session_task: Optional[Future] = None
+        self._session_lock = threading.Lock()
     
     def _get_schema(self) -> str:
-        """获取数据库Schema"""
+        """获取数据库Schema（首次读取后缓存，表结构变化后调用refresh_schema刷新）"""
+        if self._schema_text is None:
+            self._schema_text = self._load_schema()
+        return self._schema_text
+    
+    def refresh_schema(self):
+        """清除Schema缓存，下次生成SQL时重新读取"""
+        self._schema_text = None
+    
+    def _load_schema(self) -> str:
+        """从数据库读取Schema"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
@@ -79,34 +140,19 @@ class SQLQueryAgent:
             num_examples=self.num_examples
         )
         
-        sql = self.llm.invoke(prompt).strip()
+        sql = self.llm.invoke(prompt)
         
         # 清理SQL（移除可能的前缀和标记）
-        if sql.startswith("```sql"):
-            sql = sql[6:]
-        elif sql.startswith("```"):
-            sql = sql[3:]
-        
-        # 移除常见的中英文前缀
-        prefixes = ["SQL：", "SQL:", "sql:", "sql："]
-        for prefix in prefixes:
-            if sql.startswith(prefix):
-                sql = sql[len(prefix):]
-                break
-        
-        if sql.endswith("```"):
-            sql = sql[:-3]
-        
-        return sql.strip()
+        return _SQL_CLEAN_PATTERN.match(sql).group(1)
     
-    async def _execute_sql_via_mcp(self, sql: str) -> str:
-        """通过MCP工具执行SQL
+    async def _run_mcp_session(self, ready: Future):
+        """在后台事件循环中维持MCP会话，直到收到关闭信号
+        
+        stdio_client和ClientSession的上下文必须在同一个任务中进入和退出，
+        因此由该任务持有会话，其他线程通过ready拿到会话对象后提交工具调用。
         
         Args:
-            sql: SQL语句
-            
-        Returns:
-            查询结果JSON字符串
+            ready: 会话初始化完成后写入ClientSession
         """
         mcp_script = Path(__file__).parent.parent / "mcp_sql_server.py"
         server_params = StdioServerParameters(
@@ -114,20 +160,119 @@ class SQLQueryAgent:
             args=[str(mcp_script)]
         )
         
-        async with stdio_client(server_params) as (read, write):
-            async with ClientSession(read, write) as session:
-                # 初始化MCP会话
-                await session.initialize()
+        try:
+            async with stdio_client(server_params) as (read, write):
+                async with ClientSession(read, write) as session:
+                    # 初始化MCP会话
+                    await session.initialize()
+                    
+                    self._session_closed = asyncio.Event()
+                    ready.set_result(session)
+                    await self._session_closed.wait()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                print(f"MCP会话异常退出: {e}")
+        finally:
+            if not ready.done():
+                ready.set_exception(RuntimeError("MCP会话已关闭"))
+    
+    def _get_mcp_session(self) -> ClientSession:
+        """获取常驻MCP会话，不存在时启动"""
+        with self._session_lock:
+            if self._session is None:
+                if self._loop is None:
+                    self._loop = _get_background_loop()
+                    atexit.register(_close_if_alive, weakref.WeakMethod(self.close))
                 
-                # 调用execute_sql工具
-                result = await session.call_tool(
-                    "execute_sql", 
-                    arguments={"sql": sql}
-                )
+                ready = Future()
+                self._session_task = asyncio.run_coroutine_threadsafe(self._run_mcp_session(ready), self._loop)
+                self._session = ready.result(timeout=self.MCP_START_TIMEOUT)
+            return self._session
+    
+    def _close_mcp_session(self):
+        """关闭当前MCP会话（下次执行SQL时重新启动）"""
+        with self._session_lock:
+            if self._session_closed is not None:
+                self._loop.call_soon_threadsafe(self._session_closed.set)
+            if self._session_task is not None:
+                try:
+                    self._session_task.result(timeout=self.MCP_START_TIMEOUT)
+                except Exception as e:
+                    print(f"关闭MCP会话失败: {e}")
+            self._session = None
+            self._session_closed = None
+            self._session_task = None
+    
+    def close(self):
+        """关闭数据库连接和MCP会话（共享的后台事件循环随进程退出）"""
+        with self._conn_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        
+        self._close_mcp_session()
+    
+    def _execute_sql_via_mcp(self, sql: str) -> Any:
+        """通过MCP工具执行SQL
+        
+        Args:
+            sql: SQL语句
+            
+        Returns:
+            解析后的查询结果（行字典列表，或包含message/error的字典）
+        """
+        session = self._get_mcp_session()
+        
+        # 调用execute_sql工具
+        future = asyncio.run_coroutine_threadsafe(
+            session.call_tool("execute_sql", arguments={"sql": sql}),
+            self._loop
+        )
+        try:
+            result = future.result(timeout=self.MCP_CALL_TIMEOUT)
+        except Exception:
+            # 会话可能已失效（如服务进程退出），关闭后由下次调用重建
+            future.cancel()
+            self._close_mcp_session()
+            raise
+        
+        # 在边界处解析一次，下游直接使用结构化数据
+        if result.content:
+            return orjson.loads(result.content[0].text)
+        return {"error": "无返回结果"}
+    
+    def _execute_sql_local(self, sql: str) -> Any:
+        """在进程内直接执行SQL（结果结构与MCP工具一致）
+        
+        Args:
+            sql: SQL语句
+            
+        Returns:
+            查询结果（行字典列表，或包含message/error的字典）
+        """
+        try:
+            with self._conn_lock:
+                if self._conn is None:
+                    # 以只读方式打开，避免生成的SQL修改数据
+                    self._conn = sqlite3.connect(
+                        f"{Path(self.db_path).resolve().as_uri()}?mode=ro",
+                        uri=True,
+                        check_same_thread=False
+                    )
+                    self._conn.row_factory = sqlite3.Row
                 
-                if result.content:
-                    return result.content[0].text
-                return json.dumps({"error": "无返回结果"})
+                rows = self._conn.execute(sql).fetchall()
+            
+            if rows:
+                return [dict(row) for row in rows]
+            return {"message": "查询结果为空"}
+        
+        except sqlite3.Error as e:
+            return {"error": f"SQL执行错误: {str(e)}", "sql": sql}
+        except Exception as e:
+            return {"error": f"未知错误: {str(e)}"}
     
     def query(self, question: str) -> Dict[str, Any]:
         """执行查询
@@ -136,7 +281,7 @@ class SQLQueryAgent:
             question: 用户问题
             
         Returns:
-            包含SQL、结果和错误信息的字典
+            包含SQL、结果（已解析的行字典列表或message字典）和错误信息的字典
         """
         result = {
             "sql": None,
@@ -145,8 +290,11 @@ class SQLQueryAgent:
         }
         
         try:
-            # 生成SQL
-            sql = self._generate_sql(question)
+            # 生成SQL（相似问题优先复用缓存）
+            sql = self.sql_cache.get(question) if self.sql_cache else None
+            from_cache = sql is not None
+            if not from_cache:
+                sql = self._generate_sql(question)
             result["sql"] = sql
             
             if not sql:
@@ -154,13 +302,17 @@ class SQLQueryAgent:
                 return result
             
             # 执行SQL
-            query_result = asyncio.run(self._execute_sql_via_mcp(sql))
+            if self.use_mcp:
+                query_result = self._execute_sql_via_mcp(sql)
+            else:
+                query_result = self._execute_sql_local(sql)
             result["data"] = query_result
             
             # 检查是否有错误
-            result_data = json.loads(query_result)
-            if isinstance(result_data, dict) and "error" in result_data:
-                result["error"] = result_data["error"]
+            if isinstance(query_result, dict) and "error" in query_result:
+                result["error"] = query_result["error"]
+            elif self.sql_cache and not from_cache:
+                self.sql_cache.put(question, sql)
                 
         except Exception as e:
             result["error"] = f"查询失败: {str(e)}"
@@ -3,31 +3,59 @@ Flask Web API for Multi-Agent Data Query System
 提供RESTful API接口供前端调用
 """
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 import os
 import sys
+import threading
 from typing import Dict, Any
 
+import orjson
+from cachetools import LRUCache
+
 # 将当前目录添加到Python路径
 sys.path.insert(0, os.path.dirname(__file__))
 
 from agent import MultiAgentSystem
 
+
+class ORJSONProvider(JSONProvider):
+    """基于orjson的JSON序列化（jsonify和request.json都经过这里）"""
+    
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=str).decode()
+    
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+
 app = Flask(__name__, static_folder='static', static_url_path='')
+app.json = ORJSONProvider(app)
 CORS(app)  # 允许跨域请求
 
-# 全局系统实例（用于存储不同用户的会话）
-user_systems: Dict[str, MultiAgentSystem] = {}
+# 全局系统实例（用于存储不同用户的会话），按LRU淘汰长期不活跃的用户，限制内存占用；
+# 被淘汰的实例可能仍在处理请求，不主动关闭，由垃圾回收释放其线程池和数据库连接
+USER_SYSTEMS_MAX = int(os.getenv("USER_SYSTEMS_MAX", "1024"))
+user_systems: "LRUCache[str, MultiAgentSystem]" = LRUCache(maxsize=USER_SYSTEMS_MAX)
+user_systems_lock = threading.Lock()
 
 
 def get_or_create_system(user_id: str) -> MultiAgentSystem:
-    """获取或创建用户的系统实例"""
-    if user_id not in user_systems:
-        system = MultiAgentSystem()
-        system.login(user_id)
-        user_systems[user_id] = system
-    return user_systems[user_id]
+    """获取或创建用户的系统实例（多线程服务下安全）"""
+    with user_systems_lock:
+        system = user_systems.get(user_id)
+    if system is not None:
+        return system
+    
+    # 在锁外创建实例，避免阻塞其他用户的请求；并发创建时以先写入的为准
+    system = MultiAgentSystem()
+    system.login(user_id)
+    with user_systems_lock:
+        existing = user_systems.setdefault(user_id, system)
+    if existing is not system:
+        system.close()
+    return existing
 
 
 @app.route('/')
@@ -45,14 +73,12 @@ def login():
         
         # 创建或获取用户系统
         system = get_or_create_system(user_id)
-
-        # 直接从长期记忆数据库加载用户信息（无需等待对话总结）
+        
+        # 直接从长期记忆数据库加载用户信息（无需等待对话总结），一次连接读取全部内容
         ltm = system.master_agent.long_term_memory
-        profile = ltm.get_user_profile(user_id)
-        preferences = ltm.get_all_preferences(user_id)
-        knowledge = ltm.get_all_knowledge(user_id, limit=50)
-
-        return jsonify({
+        bundle = ltm.load_user_bundle(user_id, knowledge_limit=50)
+        
+        payload = orjson.dumps({
             'success': True,
             'user_id': user_id,
             'session_id': system.session_id,
@@ -61,11 +87,12 @@ def login():
                 'logged_in': True,
                 'user_id': user_id,
                 'session_id': system.session_id,
-                'profile': profile,
-                'preferences': preferences,
-                'knowledge': knowledge
+                'profile': bundle['profile'],
+                'preferences': bundle['preferences'],
+                'knowledge': bundle['knowledge']
             }
         })
+        return Response(payload, mimetype='application/json')
     except Exception as e:
         return jsonify({
             'success': False,
@@ -106,6 +133,55 @@ def query():
         }), 500
 
 
+def sse_event(payload: Dict[str, Any]) -> bytes:
+    """编码一条Server-Sent Events消息"""
+    return b'data: ' + orjson.dumps(payload) + b'\n\n'
+
+
+@app.route('/api/query_stream', methods=['POST'])
+def query_stream():
+    """流式查询接口（Server-Sent Events）
+    
+    逐段推送 {"delta": 回答片段}，结束时推送 {"done": true, ...}，出错时推送 {"error": 错误信息}
+    """
+    try:
+        data = request.json
+        user_id = data.get('user_id', 'guest')
+        question = data.get('question', '')
+        
+        if not question.strip():
+            return jsonify({
+                'success': False,
+                'error': '问题不能为空'
+            }), 400
+        
+        # 获取用户系统
+        system = get_or_create_system(user_id)
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+    
+    def generate():
+        try:
+            for chunk in system.query_stream(question):
+                yield sse_event({'delta': chunk})
+            yield sse_event({
+                'done': True,
+                'user_id': user_id,
+                'session_id': system.session_id
+            })
+        except Exception as e:
+            yield sse_event({'error': str(e)})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @app.route('/api/new_session', methods=['POST'])
 def new_session():
     """创建新会话"""
@@ -140,7 +216,7 @@ def user_info():
         ltm = system.master_agent.long_term_memory
         info = system.get_user_info()
         info['knowledge'] = ltm.get_all_knowledge(user_id, limit=50)
-
+        
         return jsonify({
             'success': True,
             'user_info': info
@@ -170,5 +246,6 @@ if __name__ == '__main__':
     print("🚀 多智能体数据查询系统 Web API 启动中...")
     print("📡 访问地址: http://localhost:5000")
     
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # 开发服务器：设置 FLASK_DEBUG=1 开启调试模式；生产环境请使用 gunicorn 启动（见 start_web.sh）
+    app.run(host='0.0.0.0', port=5000, debug=os.getenv("FLASK_DEBUG") == "1", threaded=True)
 
@@ -9,6 +9,101 @@ from datetime import datetime
 from pathlib import Path
 
 
+def create_preference_indexes(cursor: sqlite3.Cursor) -> None:
+    """创建用户偏好索引
+    
+    (user_id, key, value) 覆盖索引：按用户取全部偏好、按键取单个偏好都只需读索引，不必回表。
+    
+    Args:
+        cursor: 数据库游标
+    """
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_pref_user_key_value
+        ON user_preferences(user_id, key, value)
+    """)
+    
+    # (user_id) 已是上面索引的前缀，旧索引不再需要
+    cursor.execute("DROP INDEX IF EXISTS idx_preferences_user")
+
+
+def create_knowledge_indexes(cursor: sqlite3.Cursor) -> None:
+    """创建用户知识索引
+    
+    索引列顺序与查询的 WHERE ... ORDER BY created_at DESC LIMIT 一致，
+    取最近K条知识时可以直接按索引顺序扫描，无需额外排序。
+    
+    Args:
+        cursor: 数据库游标
+    """
+    # get_all_knowledge: WHERE user_id = ? ORDER BY created_at DESC
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_knowledge_user_created
+        ON user_knowledge(user_id, created_at DESC)
+    """)
+    
+    # get_knowledge_by_category: WHERE user_id = ? AND category = ? ORDER BY created_at DESC
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_knowledge_user_cat_created
+        ON user_knowledge(user_id, category, created_at DESC)
+    """)
+    
+    # (user_id, category) 已是上面索引的前缀，旧索引不再需要
+    cursor.execute("DROP INDEX IF EXISTS idx_knowledge_user")
+
+
+def create_knowledge_fts(cursor: sqlite3.Cursor) -> None:
+    """创建用户知识的FTS5全文索引（外部内容表 + 同步触发器）
+    
+    使用trigram分词器：中文没有空格分词，trigram按3字滑窗建索引，
+    可以在索引上完成子串匹配，替代 content LIKE '%...%' 的全表扫描。
+    
+    Args:
+        cursor: 数据库游标
+    """
+    cursor.execute("""
+        SELECT 1 FROM sqlite_master
+        WHERE type = 'table' AND name = 'user_knowledge_fts'
+    """)
+    exists = cursor.fetchone() is not None
+    
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS user_knowledge_fts USING fts5(
+            content,
+            user_id UNINDEXED,
+            category UNINDEXED,
+            content='user_knowledge',
+            content_rowid='knowledge_id',
+            tokenize='trigram'
+        )
+    """)
+    
+    # 触发器保持全文索引与知识表同步
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_knowledge_ai AFTER INSERT ON user_knowledge BEGIN
+            INSERT INTO user_knowledge_fts(rowid, content, user_id, category)
+            VALUES (new.knowledge_id, new.content, new.user_id, new.category);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_knowledge_ad AFTER DELETE ON user_knowledge BEGIN
+            INSERT INTO user_knowledge_fts(user_knowledge_fts, rowid, content, user_id, category)
+            VALUES ('delete', old.knowledge_id, old.content, old.user_id, old.category);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_knowledge_au AFTER UPDATE ON user_knowledge BEGIN
+            INSERT INTO user_knowledge_fts(user_knowledge_fts, rowid, content, user_id, category)
+            VALUES ('delete', old.knowledge_id, old.content, old.user_id, old.category);
+            INSERT INTO user_knowledge_fts(rowid, content, user_id, category)
+            VALUES (new.knowledge_id, new.content, new.user_id, new.category);
+        END
+    """)
+    
+    # 旧数据库首次创建索引时，为已有知识补建索引
+    if not exists:
+        cursor.execute("INSERT INTO user_knowledge_fts(user_knowledge_fts) VALUES ('rebuild')")
+
+
 def init_memory_database(db_path: str = "./data/long_term_memory.db") -> None:
     """初始化长期记忆数据库
     
@@ -19,6 +114,14 @@ def init_memory_database(db_path: str = "./data/long_term_memory.db") -> None:
     Path(db_path).parent.mkdir(parents=True, exist_ok=True)
     
     conn = sqlite3.connect(db_path)
+    
+    # WAL日志模式会持久化到数据库文件，之后打开的连接都会沿用
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-16000")
+    
     cursor = conn.cursor()
     
     # 创建用户信息表
@@ -44,10 +147,7 @@ def init_memory_database(db_path: str = "./data/long_term_memory.db") -> None:
     """)
     
     # 创建索引加速查询
-    cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_preferences_user 
-        ON user_preferences(user_id)
-    """)
+    create_preference_indexes(cursor)
     
     # 创建用户交互历史摘要表（长期知识）
     cursor.execute("""
@@ -63,10 +163,13 @@ def init_memory_database(db_path: str = "./data/long_term_memory.db") -> None:
     """)
     
     # 创建索引加速查询
-    cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_knowledge_user 
-        ON user_knowledge(user_id, category)
-    """)
+    create_knowledge_indexes(cursor)
+    
+    # 创建知识全文索引
+    create_knowledge_fts(cursor)
+    
+    # 收集统计信息供查询规划器选择索引
+    cursor.execute("ANALYZE")
     
     conn.commit()
     conn.close()
@@ -0,0 +1,122 @@
+"""
+LLM响应缓存
+
+按 SHA256(模型名 + 提示词) 精确缓存LLM的回答，相同提示词直接复用上次结果，跳过一次完整的LLM调用。
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+from langchain_core.language_models import BaseLLM
+
+
+class LLMCache:
+    """LLM响应精确缓存（进程内LRU）"""
+    
+    def __init__(self, max_entries: int = 4096, max_temperature: float = 0.2):
+        """初始化LLM响应缓存
+        
+        Args:
+            max_entries: 最大缓存条数，超出后按LRU淘汰
+            max_temperature: 允许缓存的最高采样温度，温度更高的模型输出随机性大，不缓存
+        """
+        self.max_entries = max_entries
+        self.max_temperature = max_temperature
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _make_key(llm: BaseLLM, prompt: str, kwargs: Dict[str, Any]) -> str:
+        """计算缓存键（同一提示词发给不同模型、使用不同调用参数时分别缓存）"""
+        model_name = getattr(llm, "model_name", None) or type(llm).__name__
+        options = repr(sorted(kwargs.items())) if kwargs else ""
+        return hashlib.sha256(f"{model_name}\0{options}\0{prompt}".encode("utf-8")).hexdigest()
+    
+    @staticmethod
+    def _get_temperature(llm: BaseLLM) -> Optional[float]:
+        """读取模型实际使用的采样温度（部分模型如Tongyi通过 model_kwargs 传入），无法确定时返回None"""
+        temperature = getattr(llm, "temperature", None)
+        if temperature is None:
+            temperature = (getattr(llm, "model_kwargs", None) or {}).get("temperature")
+        return temperature
+    
+    def is_cacheable(self, llm: BaseLLM) -> bool:
+        """判断模型输出是否足够确定，可以缓存（温度未知时不缓存）"""
+        temperature = self._get_temperature(llm)
+        return temperature is not None and temperature <= self.max_temperature
+    
+    def _get(self, key: str) -> Optional[str]:
+        """查找缓存的回答，未命中返回None"""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+    
+    def _put(self, key: str, response: str):
+        """写入缓存"""
+        with self._lock:
+            self._entries[key] = response
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def lookup(self, llm: BaseLLM, prompt: str, kwargs: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """查找缓存的回答，未命中或模型不可缓存时返回None"""
+        if not self.is_cacheable(llm):
+            return None
+        return self._get(self._make_key(llm, prompt, kwargs or {}))
+    
+    def store(self, llm: BaseLLM, prompt: str, response: str, kwargs: Optional[Dict[str, Any]] = None):
+        """写入回答（模型不可缓存时忽略），用于 llm.batch 等不经过 invoke 的调用"""
+        if self.is_cacheable(llm):
+            self._put(self._make_key(llm, prompt, kwargs or {}), response)
+    
+    def invoke(self, llm: BaseLLM, prompt: str, **kwargs: Any) -> str:
+        """带缓存地调用LLM
+        
+        Args:
+            llm: 语言模型实例
+            prompt: 提示词
+            **kwargs: 透传给 llm.invoke 的参数
+        
+        Returns:
+            LLM的回答
+        """
+        return self.get_or_call(llm, prompt, lambda: llm.invoke(prompt, **kwargs), kwargs)
+    
+    def get_or_call(self, llm: BaseLLM, prompt: str, call: Callable[[], str],
+                    kwargs: Optional[Dict[str, Any]] = None) -> str:
+        """查找缓存，未命中时用指定方式调用LLM（如流式调用）并写入缓存
+        
+        Args:
+            llm: 语言模型实例
+            prompt: 提示词
+            call: 未命中时执行的调用，返回LLM的回答
+            kwargs: 调用参数（参与缓存键计算）
+        
+        Returns:
+            LLM的回答
+        """
+        if not self.is_cacheable(llm):
+            return call()
+        
+        key = self._make_key(llm, prompt, kwargs or {})
+        cached = self._get(key)
+        if cached is not None:
+            return cached
+        
+        response = call()
+        self._put(key, response)
+        return response
+
+
+# 进程内共享的默认缓存
+default_llm_cache = LLMCache()
+
+
+def cached_invoke(llm: BaseLLM, prompt: str, **kwargs: Any) -> str:
+    """使用默认缓存调用LLM（相同模型、相同提示词直接返回上次结果）"""
+    return default_llm_cache.invoke(llm, prompt, **kwargs)
@@ -6,8 +6,11 @@
 
 import sqlite3
 import json
+import threading
 from pathlib import Path
+from typing import Optional
 
+import orjson
 from mcp.server.fastmcp import FastMCP
 
 # 创建FastMCP服务器
@@ -19,6 +22,30 @@ DB_CONFIG = {
     "path": Path(__file__).parent / "data" / "company.db"
 }
 
+# 每批从游标读取的行数
+FETCH_BATCH_SIZE = 1000
+
+# 常驻只读连接：首次查询时打开，之后所有工具调用复用
+_conn: Optional[sqlite3.Connection] = None
+_conn_lock = threading.Lock()
+
+
+def _get_connection() -> sqlite3.Connection:
+    """获取常驻的只读数据库连接（调用方需持有 _conn_lock）"""
+    global _conn
+    if _conn is None:
+        # 以只读方式打开，避免工具调用修改数据
+        _conn = sqlite3.connect(
+            f"{Path(DB_CONFIG['path']).resolve().as_uri()}?mode=ro",
+            uri=True,
+            check_same_thread=False
+        )
+        _conn.execute("PRAGMA query_only=1")
+        _conn.execute("PRAGMA mmap_size=268435456")
+        _conn.execute("PRAGMA cache_size=-32000")
+        _conn.execute("PRAGMA temp_store=MEMORY")
+    return _conn
+
 
 @mcp.tool()
 def execute_sql(sql: str) -> str:
@@ -34,25 +61,33 @@ def execute_sql(sql: str) -> str:
     return _execute_sqlite(sql)
 
 
+def _iter_rows(cursor: sqlite3.Cursor):
+    """按批读取查询结果，逐行生成 {列名: 值} 字典"""
+    columns = [desc[0] for desc in cursor.description] if cursor.description else []
+    while True:
+        rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield dict(zip(columns, row))
+
+
 def _execute_sqlite(sql: str) -> str:
     """执行SQLite查询"""
-    db_path = DB_CONFIG["path"]
-    
     try:
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute(sql)
-        rows = cursor.fetchall()
+        with _conn_lock:
+            cursor = _get_connection().cursor()
+            cursor.execute(sql)
+            
+            # 直接用列名与行元组构造字典，省去sqlite3.Row包装和中间行列表
+            result = list(_iter_rows(cursor))
         
-        if rows:
-            result = [dict(row) for row in rows]
-            output = json.dumps(result, ensure_ascii=False, indent=2)
+        if result:
+            # 结果集可能很大，用orjson紧凑序列化；BLOB等非JSON类型转为字符串
+            output = orjson.dumps(result, default=str).decode()
         else:
             output = json.dumps({"message": "查询结果为空"})
         
-        conn.close()
         return output
         
     except sqlite3.Error as e:
@@ -0,0 +1,47 @@
+"""
+对话格式化
+
+将消息列表渲染为"角色: 内容"的对话文本，供历史压缩、意图识别和记忆提取共用。
+"""
+
+from typing import Sequence
+
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+
+# 各消息类型的角色前缀（按类型查表，不做逐条isinstance判断），其他类型的消息不输出
+ROLE_PREFIXES = {HumanMessage: "用户: ", AIMessage: "助手: "}
+
+
+def format_conversation(messages: Sequence[BaseMessage]) -> str:
+    """格式化消息列表为对话文本
+    
+    Args:
+        messages: 消息列表
+    
+    Returns:
+        格式化的对话文本，每条消息一行
+    """
+    return "\n".join(
+        f"{ROLE_PREFIXES[type(msg)]}{msg.content}" for msg in messages if type(msg) in ROLE_PREFIXES
+    )
+
+
+def format_conversation_tail(messages: Sequence[BaseMessage], k: int) -> str:
+    """格式化最近k条对话消息（从后往前只取需要的消息，不格式化整个列表）
+    
+    Args:
+        messages: 消息列表
+        k: 保留的消息条数
+    
+    Returns:
+        格式化的对话文本
+    """
+    if k <= 0:
+        return ""
+    tail = []
+    for msg in reversed(messages):
+        if type(msg) in ROLE_PREFIXES:
+            tail.append(msg)
+            if len(tail) == k:
+                break
+    return format_conversation(tail[::-1])
@@ -5,14 +5,56 @@
 """
 
 import sqlite3
+import threading
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 from pathlib import Path
 
 
 class LongTermMemory:
     """长期记忆管理器 - 跨会话持久化用户信息"""
     
+    # 连接级PRAGMA（每个新连接都需要设置；journal_mode=WAL 已在建库时持久化）
+    CONNECTION_PRAGMAS = (
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA cache_size=-16000",
+    )
+    
+    # 偏好读取语句（固定SQL文本，长连接上复用sqlite3的预编译语句缓存；两者均可只读覆盖索引完成）
+    GET_PREFERENCE_SQL = "SELECT value FROM user_preferences WHERE user_id = ? AND key = ?"
+    ALL_PREFERENCES_SQL = "SELECT key, value FROM user_preferences WHERE user_id = ?"
+    
+    # 相关知识检索语句：只返回调用方需要的列
+    RELEVANT_KNOWLEDGE_FTS_SQL = """
+        SELECT k.knowledge_id, k.category, k.content, k.confidence
+        FROM user_knowledge_fts f
+        JOIN user_knowledge k ON k.knowledge_id = f.rowid
+        WHERE user_knowledge_fts MATCH ? AND k.user_id = ?
+        ORDER BY bm25(user_knowledge_fts), k.confidence DESC, k.created_at DESC
+        LIMIT ?
+    """
+    # 短查询（不足3个字符，无法使用trigram索引）：instr 直接绑定原文，无需拼接通配符，也不会把 %、_ 当作通配符
+    RELEVANT_KNOWLEDGE_SHORT_SQL = """
+        SELECT knowledge_id, category, content, confidence
+        FROM user_knowledge
+        WHERE user_id = ? AND instr(content, ?) > 0
+        ORDER BY confidence DESC, created_at DESC
+        LIMIT ?
+    """
+    
+    # 每累计写入多少次执行一次 PRAGMA optimize，长期运行的进程中保持统计信息更新
+    OPTIMIZE_EVERY_WRITES = 200
+    
+    # 创建用户或刷新最后活跃时间
+    UPSERT_USER_SQL = """
+        INSERT INTO users (user_id, created_at, last_active)
+        VALUES (?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+        ON CONFLICT(user_id) DO UPDATE SET
+            last_active = CURRENT_TIMESTAMP
+    """
+    
     def __init__(self, memory_db_path: str = "./data/long_term_memory.db"):
         """初始化长期记忆管理器
         
@@ -21,19 +63,85 @@ class LongTermMemory:
         """
         self.db_path = memory_db_path
         self._ensure_database()
+        
+        # 所有方法共用一个长连接，避免每次操作都重新打开数据库文件；跨线程访问由锁串行化
+        self._conn = self._connect()
+        self._lock = threading.Lock()
+        
+        # 记忆版本号：写入后递增，供调用方判断缓存的记忆内容是否过期
+        self._global_version = 0
+        self._user_versions: Dict[str, int] = {}
+        self._writes_since_optimize = 0
     
     def _ensure_database(self):
         """确保数据库文件存在，如果不存在则初始化"""
         if not Path(self.db_path).exists():
             from data.init_memory_db import init_memory_database
             init_memory_database(self.db_path)
+        else:
+            # 兼容旧版本创建的数据库：切换为WAL模式（持久化，只需执行一次），补建索引和全文索引
+            from data.init_memory_db import (
+                create_preference_indexes, create_knowledge_indexes, create_knowledge_fts
+            )
+            conn = sqlite3.connect(self.db_path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            cursor = conn.cursor()
+            create_preference_indexes(cursor)
+            create_knowledge_indexes(cursor)
+            create_knowledge_fts(cursor)
+            conn.commit()
+            conn.close()
     
-    def _get_connection(self) -> sqlite3.Connection:
-        """获取数据库连接"""
-        conn = sqlite3.connect(self.db_path)
+    def _connect(self) -> sqlite3.Connection:
+        """创建数据库连接并应用连接级PRAGMA"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
         conn.row_factory = sqlite3.Row  # 返回字典形式的结果
+        for pragma in self.CONNECTION_PRAGMAS:
+            conn.execute(pragma)
         return conn
     
+    def _get_connection(self) -> sqlite3.Connection:
+        """获取共享的数据库连接（调用方需持有 self._lock）"""
+        return self._conn
+    
+    def close(self):
+        """更新查询规划器统计信息后关闭数据库连接"""
+        with self._lock:
+            try:
+                self._conn.execute("PRAGMA optimize")
+            except sqlite3.Error as e:
+                print(f"优化数据库失败: {e}")
+            self._conn.close()
+    
+    def get_version(self, user_id: str) -> tuple:
+        """获取用户记忆的版本号（偏好或知识发生变化后改变）
+        
+        Args:
+            user_id: 用户ID
+            
+        Returns:
+            版本号
+        """
+        return (self._global_version, self._user_versions.get(user_id, 0))
+    
+    def _bump_version(self, user_id: Optional[str] = None):
+        """记忆写入后递增版本号，未指定用户时使所有用户的版本失效
+        
+        调用方需持有 self._lock；写入累计到一定次数时顺带执行 PRAGMA optimize。
+        """
+        if user_id is None:
+            self._global_version += 1
+        else:
+            self._user_versions[user_id] = self._user_versions.get(user_id, 0) + 1
+        
+        self._writes_since_optimize += 1
+        if self._writes_since_optimize >= self.OPTIMIZE_EVERY_WRITES:
+            self._writes_since_optimize = 0
+            try:
+                self._conn.execute("PRAGMA optimize")
+            except sqlite3.Error as e:
+                print(f"优化数据库失败: {e}")
+    
     # ==================== 用户管理 ====================
     
     def get_user_profile(self, user_id: str) -> Optional[Dict[str, Any]]:
@@ -45,21 +153,21 @@ class LongTermMemory:
         Returns:
             用户信息字典，如果用户不存在则返回None
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT user_id, created_at, last_active
-            FROM users
-            WHERE user_id = ?
-        """, (user_id,))
-        
-        row = cursor.fetchone()
-        conn.close()
-        
-        if row:
-            return dict(row)
-        return None
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT user_id, created_at, last_active
+                FROM users
+                WHERE user_id = ?
+            """, (user_id,))
+            
+            row = cursor.fetchone()
+            
+            if row:
+                return dict(row)
+            return None
     
     def create_or_update_user(self, user_id: str) -> bool:
         """创建或更新用户记录
@@ -70,24 +178,18 @@ class LongTermMemory:
         Returns:
             是否成功
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute("""
-                INSERT INTO users (user_id, created_at, last_active)
-                VALUES (?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-                ON CONFLICT(user_id) DO UPDATE SET
-                    last_active = CURRENT_TIMESTAMP
-            """, (user_id,))
+        with self._lock:
+            conn = self._get_connection()
+            
+            try:
+                # with conn：正常退出时提交，出现异常时自动回滚
+                with conn:
+                    conn.execute(self.UPSERT_USER_SQL, (user_id,))
+            except Exception as e:
+                print(f"创建/更新用户失败: {e}")
+                return False
             
-            conn.commit()
             return True
-        except Exception as e:
-            print(f"创建/更新用户失败: {e}")
-            return False
-        finally:
-            conn.close()
     
     def update_user_activity(self, user_id: str) -> bool:
         """更新用户最后活跃时间
@@ -113,28 +215,42 @@ class LongTermMemory:
         Returns:
             是否成功
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
+        return self.save_many_preferences(user_id, {key: value})
+    
+    def save_many_preferences(self, user_id: str, preferences: Dict[str, str]) -> bool:
+        """批量保存用户偏好（一个事务内写入）
         
-        try:
-            # 确保用户存在
-            self.create_or_update_user(user_id)
+        Args:
+            user_id: 用户ID
+            preferences: 偏好字典 {key: value}
             
-            cursor.execute("""
-                INSERT INTO user_preferences (user_id, key, value, updated_at)
-                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-                ON CONFLICT(user_id, key) DO UPDATE SET
-                    value = excluded.value,
-                    updated_at = CURRENT_TIMESTAMP
-            """, (user_id, key, value))
+        Returns:
+            是否成功
+        """
+        if not preferences:
+            return True
+        
+        with self._lock:
+            conn = self._get_connection()
             
-            conn.commit()
+            try:
+                with conn:
+                    # 确保用户存在（与写入放在同一个事务中，只提交一次）
+                    conn.execute(self.UPSERT_USER_SQL, (user_id,))
+                    
+                    conn.executemany("""
+                        INSERT INTO user_preferences (user_id, key, value, updated_at)
+                        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                        ON CONFLICT(user_id, key) DO UPDATE SET
+                            value = excluded.value,
+                            updated_at = CURRENT_TIMESTAMP
+                    """, [(user_id, key, value) for key, value in preferences.items()])
+            except Exception as e:
+                print(f"保存偏好失败: {e}")
+                return False
+            
+            self._bump_version(user_id)
             return True
-        except Exception as e:
-            print(f"保存偏好失败: {e}")
-            return False
-        finally:
-            conn.close()
     
     def get_preference(self, user_id: str, key: str, default: Optional[str] = None) -> Optional[str]:
         """获取用户偏好
@@ -147,21 +263,17 @@ class LongTermMemory:
         Returns:
             偏好值，如果不存在则返回默认值
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT value
-            FROM user_preferences
-            WHERE user_id = ? AND key = ?
-        """, (user_id, key))
-        
-        row = cursor.fetchone()
-        conn.close()
-        
-        if row:
-            return row["value"]
-        return default
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute(self.GET_PREFERENCE_SQL, (user_id, key))
+            
+            row = cursor.fetchone()
+            
+            if row:
+                return row["value"]
+            return default
     
     def get_all_preferences(self, user_id: str) -> Dict[str, str]:
         """获取用户的所有偏好
@@ -172,19 +284,15 @@ class LongTermMemory:
         Returns:
             偏好字典
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT key, value
-            FROM user_preferences
-            WHERE user_id = ?
-        """, (user_id,))
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
-        return {row["key"]: row["value"] for row in rows}
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute(self.ALL_PREFERENCES_SQL, (user_id,))
+            
+            rows = cursor.fetchall()
+            
+            return {row["key"]: row["value"] for row in rows}
     
     # ==================== 用户知识管理 ====================
     
@@ -206,25 +314,39 @@ class LongTermMemory:
         Returns:
             是否成功
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
+        return self.save_many_knowledge(user_id, [(category, content, confidence)])
+    
+    def save_many_knowledge(self, user_id: str, items: List[Tuple[str, str, float]]) -> bool:
+        """批量保存用户知识（一个事务内写入）
         
-        try:
-            # 确保用户存在
-            self.create_or_update_user(user_id)
+        Args:
+            user_id: 用户ID
+            items: 知识列表 [(分类, 内容, 置信度), ...]
             
-            cursor.execute("""
-                INSERT INTO user_knowledge (user_id, category, content, confidence, created_at)
-                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-            """, (user_id, category, content, confidence))
+        Returns:
+            是否成功
+        """
+        if not items:
+            return True
+        
+        with self._lock:
+            conn = self._get_connection()
             
-            conn.commit()
+            try:
+                with conn:
+                    # 确保用户存在（与写入放在同一个事务中，只提交一次）
+                    conn.execute(self.UPSERT_USER_SQL, (user_id,))
+                    
+                    conn.executemany("""
+                        INSERT INTO user_knowledge (user_id, category, content, confidence, created_at)
+                        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    """, [(user_id, category, content, confidence) for category, content, confidence in items])
+            except Exception as e:
+                print(f"保存知识失败: {e}")
+                return False
+            
+            self._bump_version(user_id)
             return True
-        except Exception as e:
-            print(f"保存知识失败: {e}")
-            return False
-        finally:
-            conn.close()
     
     def get_knowledge_by_category(
         self, 
@@ -242,21 +364,21 @@ class LongTermMemory:
         Returns:
             知识列表
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT knowledge_id, category, content, confidence, created_at
-            FROM user_knowledge
-            WHERE user_id = ? AND category = ?
-            ORDER BY created_at DESC
-            LIMIT ?
-        """, (user_id, category, limit))
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
-        return [dict(row) for row in rows]
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT knowledge_id, category, content, confidence, created_at
+                FROM user_knowledge
+                WHERE user_id = ? AND category = ?
+                ORDER BY created_at DESC
+                LIMIT ?
+            """, (user_id, category, limit))
+            
+            rows = cursor.fetchall()
+            
+            return [dict(row) for row in rows]
     
     def get_relevant_knowledge(
         self, 
@@ -266,7 +388,8 @@ class LongTermMemory:
     ) -> List[Dict[str, Any]]:
         """检索与查询相关的用户知识
         
-        使用简单的关键词匹配策略
+        通过FTS5 trigram全文索引做子串匹配，按bm25相关度和置信度排序；
+        不足3个字符的查询无法使用trigram索引，退回 instr 子串匹配。
         
         Args:
             user_id: 用户ID
@@ -274,25 +397,56 @@ class LongTermMemory:
             top_k: 返回前K个结果
             
         Returns:
-            相关知识列表
+            相关知识列表 [{knowledge_id, category, content, confidence}, ...]
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        # 简单的关键词匹配（使用LIKE）
-        # 在生产环境中可以使用FTS5全文搜索或向量检索
-        cursor.execute("""
-            SELECT knowledge_id, category, content, confidence, created_at
-            FROM user_knowledge
-            WHERE user_id = ? AND content LIKE ?
-            ORDER BY confidence DESC, created_at DESC
-            LIMIT ?
-        """, (user_id, f"%{query}%", top_k))
-        
-        rows = cursor.fetchall()
-        conn.close()
+        with self._lock:
+            return self._select_relevant_knowledge(self._get_connection().cursor(), user_id, query, top_k)
+    
+    def _select_relevant_knowledge(
+        self,
+        cursor: sqlite3.Cursor,
+        user_id: str,
+        query: str,
+        top_k: int
+    ) -> List[Dict[str, Any]]:
+        """执行相关知识检索查询（调用方需持有 self._lock）"""
+        if len(query) >= 3:
+            # 整个查询作为一个短语匹配（双引号转义）
+            phrase = '"' + query.replace('"', '""') + '"'
+            cursor.execute(self.RELEVANT_KNOWLEDGE_FTS_SQL, (phrase, user_id, top_k))
+        else:
+            cursor.execute(self.RELEVANT_KNOWLEDGE_SHORT_SQL, (user_id, query, top_k))
+        
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def load_context(self, user_id: str, query: str, top_k: int = 3) -> Dict[str, Any]:
+        """一次读取每轮对话所需的长期记忆上下文（全部偏好 + 相关知识，共用一个读事务）
         
-        return [dict(row) for row in rows]
+        Args:
+            user_id: 用户ID
+            query: 查询文本
+            top_k: 相关知识返回数量
+            
+        Returns:
+            {"preferences": 偏好字典, "knowledge": 相关知识列表}
+        """
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            
+            # 显式开启读事务，两次查询看到同一份数据快照（with conn 退出时结束事务）
+            with conn:
+                cursor.execute("BEGIN")
+                
+                cursor.execute(self.ALL_PREFERENCES_SQL, (user_id,))
+                preferences = {r["key"]: r["value"] for r in cursor.fetchall()}
+                
+                knowledge = self._select_relevant_knowledge(cursor, user_id, query, top_k)
+            
+            return {
+                "preferences": preferences,
+                "knowledge": knowledge
+            }
     
     def get_all_knowledge(self, user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
         """获取用户的所有知识
@@ -304,21 +458,64 @@ class LongTermMemory:
         Returns:
             知识列表
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT knowledge_id, category, content, confidence, created_at
-            FROM user_knowledge
-            WHERE user_id = ?
-            ORDER BY created_at DESC
-            LIMIT ?
-        """, (user_id, limit))
-        
-        rows = cursor.fetchall()
-        conn.close()
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT knowledge_id, category, content, confidence, created_at
+                FROM user_knowledge
+                WHERE user_id = ?
+                ORDER BY created_at DESC
+                LIMIT ?
+            """, (user_id, limit))
+            
+            rows = cursor.fetchall()
+            
+            return [dict(row) for row in rows]
+    
+    def load_user_bundle(self, user_id: str, knowledge_limit: int = 50) -> Dict[str, Any]:
+        """一次读取用户概况、全部偏好和知识（共用一个连接和读事务）
         
-        return [dict(row) for row in rows]
+        Args:
+            user_id: 用户ID
+            knowledge_limit: 知识返回数量限制
+            
+        Returns:
+            {"profile": 用户信息或None, "preferences": 偏好字典, "knowledge": 知识列表}
+        """
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            
+            # 显式开启读事务，三次查询看到同一份数据快照（with conn 退出时结束事务）
+            with conn:
+                cursor.execute("BEGIN")
+                
+                cursor.execute("""
+                    SELECT user_id, created_at, last_active
+                    FROM users
+                    WHERE user_id = ?
+                """, (user_id,))
+                row = cursor.fetchone()
+                
+                cursor.execute(self.ALL_PREFERENCES_SQL, (user_id,))
+                preferences = {r["key"]: r["value"] for r in cursor.fetchall()}
+                
+                cursor.execute("""
+                    SELECT knowledge_id, category, content, confidence, created_at
+                    FROM user_knowledge
+                    WHERE user_id = ?
+                    ORDER BY created_at DESC
+                    LIMIT ?
+                """, (user_id, knowledge_limit))
+                knowledge = [dict(r) for r in cursor.fetchall()]
+            
+            return {
+                "profile": dict(row) if row else None,
+                "preferences": preferences,
+                "knowledge": knowledge
+            }
     
     # ==================== 工具方法 ====================
     
@@ -332,22 +529,21 @@ class LongTermMemory:
         Returns:
             是否成功
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute("""
-                DELETE FROM user_preferences
-                WHERE user_id = ? AND key = ?
-            """, (user_id, key))
+        with self._lock:
+            conn = self._get_connection()
             
-            conn.commit()
+            try:
+                with conn:
+                    conn.execute("""
+                        DELETE FROM user_preferences
+                        WHERE user_id = ? AND key = ?
+                    """, (user_id, key))
+            except Exception as e:
+                print(f"删除偏好失败: {e}")
+                return False
+            
+            self._bump_version(user_id)
             return True
-        except Exception as e:
-            print(f"删除偏好失败: {e}")
-            return False
-        finally:
-            conn.close()
     
     def delete_knowledge(self, knowledge_id: int) -> bool:
         """删除指定知识
@@ -358,20 +554,19 @@ class LongTermMemory:
         Returns:
             是否成功
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute("""
-                DELETE FROM user_knowledge
-                WHERE knowledge_id = ?
-            """, (knowledge_id,))
+        with self._lock:
+            conn = self._get_connection()
             
-            conn.commit()
+            try:
+                with conn:
+                    conn.execute("""
+                        DELETE FROM user_knowledge
+                        WHERE knowledge_id = ?
+                    """, (knowledge_id,))
+            except Exception as e:
+                print(f"删除知识失败: {e}")
+                return False
+            
+            self._bump_version()
             return True
-        except Exception as e:
-            print(f"删除知识失败: {e}")
-            return False
-        finally:
-            conn.close()
 
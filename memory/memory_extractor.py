@@ -4,15 +4,88 @@
 从对话历史中自动提取用户偏好和知识。
 """
 
-import json
-from typing import List, Dict, Any
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+import orjson
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
 from langchain_core.language_models import BaseLLM
+from pydantic import BaseModel, Field
+
+from llm_cache import default_llm_cache
+from memory.formatting import ROLE_PREFIXES
+
+# 匹配LLM回答中的Markdown代码块（```json ... ``` 或 ``` ... ```，流式提前截断时可能缺少结束标记）
+_FENCE_PATTERN = re.compile(r"```(?:json)?\s*(.*?)\s*(?:```|$)", re.S | re.I)
+
+# 助手回答中的JSON代码块（查询结果等原始数据，对提取偏好没有帮助）
+_JSON_BLOCK_PATTERN = re.compile(r"```json.*?```", re.S | re.I)
+
+
+def _compact(content: str, head: int = 200, tail: int = 200) -> str:
+    """压缩助手回答：去掉JSON代码块，过长时只保留开头和结尾"""
+    content = _JSON_BLOCK_PATTERN.sub("[JSON已省略]", content)
+    if len(content) <= head + tail + 20:
+        return content
+    return f"{content[:head]}…[已省略]…{content[-tail:]}"
+
+
+class KnowledgeItem(BaseModel):
+    """结构化输出：一条用户知识"""
+    category: str = Field(description="知识类型：常问问题、业务领域或使用习惯")
+    content: str = Field(description="知识内容")
+    confidence: float = Field(description="置信度（0-1）")
+
+
+class ExtractionResult(BaseModel):
+    """结构化输出：偏好和知识的合并提取结果"""
+    preferences: Dict[str, Any] = Field(default_factory=dict, description="用户偏好键值")
+    knowledge: List[KnowledgeItem] = Field(default_factory=list, description="用户知识列表")
+
+
+class _JsonCompletionScanner:
+    """逐块扫描流式输出，判断第一个顶层JSON对象/数组是否已经闭合（忽略字符串内的括号）"""
+    
+    __slots__ = ("depth", "started", "in_string", "escaped")
+    
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+    
+    def feed(self, chunk: str) -> bool:
+        """扫描一块输出，顶层JSON闭合时返回True"""
+        for ch in chunk:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                if self.started:
+                    self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+                self.started = True
+            elif ch in "}]" and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+        return False
 
 
 class MemoryExtractor:
     """从对话中提取长期记忆"""
     
+    # 提取记录最多保留的用户数
+    MAX_TRACKED_USERS = 1024
+    
     def __init__(self, llm: BaseLLM):
         """初始化记忆提取器
         
@@ -20,10 +93,25 @@ class MemoryExtractor:
             llm: 语言模型实例
         """
         self.llm = llm
+        self._lock = threading.Lock()
+        # 各用户上次成功提取时的状态：user_id -> (消息数, 最后一条消息的哈希)
+        self._last_extracted: "OrderedDict[str, Tuple[int, str]]" = OrderedDict()
+        self._structured_llm = self._build_structured_llm(llm)
+    
+    @staticmethod
+    def _build_structured_llm(llm: BaseLLM):
+        """构建结构化输出的模型（JSON模式/函数调用），模型不支持时返回None，改为解析文本回答"""
+        with_structured_output = getattr(llm, "with_structured_output", None)
+        if with_structured_output is None:
+            return None
+        try:
+            return with_structured_output(ExtractionResult)
+        except NotImplementedError:
+            return None
     
     def extract_preferences_from_conversation(
-        self, 
-        messages: List[BaseMessage], 
+        self,
+        messages: List[BaseMessage],
         user_id: str
     ) -> Dict[str, Any]:
         """从对话中提取用户偏好
@@ -31,56 +119,15 @@ class MemoryExtractor:
         Args:
             messages: 对话消息列表
             user_id: 用户ID
-            
+        
         Returns:
             提取的偏好字典 {category: {key: value, ...}}
         """
-        if len(messages) < 4:  # 至少需要2轮对话
-            return {}
-        
-        # 格式化对话历史
-        conversation_text = self._format_conversation(messages)
-        
-        prompt = f"""请分析以下对话，提取用户的偏好信息。
-
-对话内容：
-{conversation_text}
-
-请提取以下类型的用户偏好：
-1. favorite_department: 用户经常询问或关注的部门
-2. query_focus: 用户的查询重点（如：薪资、人员、绩效等）
-3. display_preference: 用户偏好的数据展示方式
-4. common_topics: 用户常问的话题
-
-以JSON格式返回（只返回JSON，不要其他文字）：
-{{
-    "favorite_department": "研发部",
-    "query_focus": "薪资分析",
-    ...
-}}
-
-如果无法提取某项偏好，则不要包含该键。
-"""
-        
-        try:
-            response = self.llm.invoke(prompt).strip()
-            
-            # 尝试解析JSON
-            # 清理可能的代码块标记
-            if "```json" in response:
-                response = response.split("```json")[1].split("```")[0].strip()
-            elif "```" in response:
-                response = response.split("```")[1].split("```")[0].strip()
-            
-            preferences = json.loads(response)
-            return preferences
-        except Exception as e:
-            print(f"提取偏好失败: {e}")
-            return {}
+        return self.extract_all(messages, user_id)[0]
     
     def extract_knowledge_from_conversation(
-        self, 
-        messages: List[BaseMessage], 
+        self,
+        messages: List[BaseMessage],
         user_id: str
     ) -> List[Dict[str, Any]]:
         """从对话中提取用户知识点
@@ -88,86 +135,293 @@ class MemoryExtractor:
         Args:
             messages: 对话消息列表
             user_id: 用户ID
-            
+        
         Returns:
             提取的知识列表 [{category, content, confidence}, ...]
         """
-        if len(messages) < 4:
-            return []
+        return self.extract_all(messages, user_id)[1]
+    
+    def extract_all(
+        self,
+        messages: List[BaseMessage],
+        user_id: str
+    ) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """同时提取用户偏好和知识
+        
+        偏好和知识基于同一段对话，合并为一次LLM调用，返回同时包含两部分的JSON。
+        
+        Args:
+            messages: 对话消息列表
+            user_id: 用户ID
+        
+        Returns:
+            (偏好字典, 知识列表)
+        """
+        if len(messages) < 4:  # 至少需要2轮对话
+            return {}, []
         
         conversation_text = self._format_conversation(messages)
+        prompt = self._build_extraction_prompt(conversation_text)
         
-        prompt = f"""请分析以下对话，提取值得记住的用户知识点。
+        try:
+            if self._structured_llm is not None:
+                # 结构化输出保证是合法JSON，序列化后与文本回答走同一套缓存和校验
+                call = lambda: self._structured_llm.invoke(prompt).model_dump_json()
+            else:
+                call = lambda: self._stream_json(prompt)
+            response = default_llm_cache.get_or_call(self.llm, prompt, call)
+        except Exception as e:
+            print(f"提取记忆失败: {e}")
+            return {}, []
+        
+        return self._finish_extraction(messages, user_id, response)
+    
+    def extract_all_batch(
+        self,
+        conversations: List[Tuple[List[BaseMessage], str]],
+        max_concurrency: int = 8
+    ) -> List[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+        """批量提取多个对话（可来自不同用户）的偏好和知识
+        
+        所有提示词通过一次 llm.batch 并发发送，单个对话失败不影响其他对话。
+        
+        Args:
+            conversations: [(对话消息列表, 用户ID), ...]
+            max_concurrency: 最大并发请求数
+        
+        Returns:
+            与输入顺序一致的 [(偏好字典, 知识列表), ...]
+        """
+        results: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]] = [({}, []) for _ in conversations]
+        
+        # 对话过短的跳过，不发送请求
+        prompts = {
+            i: self._build_extraction_prompt(self._format_conversation(messages))
+            for i, (messages, _) in enumerate(conversations) if len(messages) >= 4
+        }
+        
+        # 先查响应缓存，只批量发送未命中的提示词
+        responses: Dict[int, str] = {}
+        pending = []
+        for i, prompt in prompts.items():
+            cached = default_llm_cache.lookup(self.llm, prompt)
+            if cached is not None:
+                responses[i] = cached
+            else:
+                pending.append(i)
+        
+        if pending:
+            outputs = self.llm.batch(
+                [prompts[i] for i in pending],
+                config={"max_concurrency": max_concurrency},
+                return_exceptions=True
+            )
+            for i, output in zip(pending, outputs):
+                if isinstance(output, Exception):
+                    print(f"提取记忆失败（用户 {conversations[i][1]}）: {output}")
+                    continue
+                default_llm_cache.store(self.llm, prompts[i], output)
+                responses[i] = output
+        
+        for i, response in responses.items():
+            results[i] = self._finish_extraction(*conversations[i], response)
+        
+        return results
+    
+    def _finish_extraction(
+        self,
+        messages: List[BaseMessage],
+        user_id: str,
+        response: str
+    ) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """解析并校验LLM回答，成功时记录本次提取（单个和批量提取共用）"""
+        try:
+            result = self._parse_extraction(response)
+        except ValueError as e:
+            print(f"解析提取结果失败（用户 {user_id}）: {e}")
+            return {}, []
+        
+        self._record_extraction(messages, user_id)
+        return result
+    
+    def _stream_json(self, prompt: str) -> str:
+        """流式调用LLM，顶层JSON闭合后立即停止接收，不再等待模型输出后面的多余文字
+        
+        Args:
+            prompt: 提示词
+        
+        Returns:
+            截至JSON闭合处的回答（流中没有完整JSON时为完整回答）
+        """
+        scanner = _JsonCompletionScanner()
+        chunks = []
+        stream = self.llm.stream(prompt)
+        try:
+            for chunk in stream:
+                chunks.append(chunk)
+                if scanner.feed(chunk):
+                    break
+        finally:
+            # 关闭生成器以释放底层HTTP流，让服务端停止生成
+            stream.close()
+        
+        return "".join(chunks)
+    
+    def _build_extraction_prompt(self, conversation_text: str) -> str:
+        """构建偏好和知识的合并提取提示词"""
+        return f"""请分析以下对话，提取用户的偏好信息和值得记住的用户知识点。
 
 对话内容：
 {conversation_text}
 
-请提取以下类型的知识：
+一、用户偏好（preferences），可包含以下键：
+1. favorite_department: 用户经常询问或关注的部门
+2. query_focus: 用户的查询重点（如：薪资、人员、绩效等）
+3. display_preference: 用户偏好的数据展示方式
+4. common_topics: 用户常问的话题
+如果无法提取某项偏好，则不要包含该键。
+
+二、用户知识（knowledge），可包含以下类型：
 1. 常问问题：用户反复询问的问题或关注点
 2. 业务领域：用户的工作领域或业务重点
 3. 使用习惯：用户的查询和分析习惯
+confidence是置信度（0-1），根据对话中该知识的明确程度评估。
+如果没有值得记录的知识，knowledge 返回空数组 []。
 
-以JSON数组格式返回（只返回JSON，不要其他文字）：
-[
-    {{
-        "category": "常问问题",
-        "content": "经常询问研发部的薪资情况",
-        "confidence": 0.9
+以JSON格式返回（只返回JSON，不要其他文字）：
+{{
+    "preferences": {{
+        "favorite_department": "研发部",
+        "query_focus": "薪资分析",
+        ...
     }},
-    ...
-]
-
-confidence是置信度（0-1），根据对话中该知识的明确程度评估。
-如果没有值得记录的知识，返回空数组 []。
+    "knowledge": [
+        {{
+            "category": "常问问题",
+            "content": "经常询问研发部的薪资情况",
+            "confidence": 0.9
+        }},
+        ...
+    ]
+}}
 """
+    
+    def _strip_code_fence(self, response: str) -> str:
+        """清理可能的代码块标记"""
+        match = _FENCE_PATTERN.search(response)
+        return (match.group(1) if match else response).strip()
+    
+    def _parse_extraction(self, response: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """解析合并提取结果"""
+        result = orjson.loads(self._strip_code_fence(response))
+        if not isinstance(result, dict):
+            return {}, []
         
-        try:
-            response = self.llm.invoke(prompt).strip()
-            
-            # 清理可能的代码块标记
-            if "```json" in response:
-                response = response.split("```json")[1].split("```")[0].strip()
-            elif "```" in response:
-                response = response.split("```")[1].split("```")[0].strip()
-            
-            knowledge_list = json.loads(response)
-            
-            # 验证格式
-            if isinstance(knowledge_list, list):
-                return knowledge_list
-            return []
-        except Exception as e:
-            print(f"提取知识失败: {e}")
-            return []
+        # 验证格式
+        preferences = result.get("preferences")
+        knowledge_list = result.get("knowledge")
+        return (
+            preferences if isinstance(preferences, dict) else {},
+            self._validate_knowledge(knowledge_list) if isinstance(knowledge_list, list) else []
+        )
+    
+    @staticmethod
+    def _validate_knowledge(knowledge_list: List[Any]) -> List[Dict[str, Any]]:
+        """校验知识列表：丢弃没有内容的条目，置信度转为0-1之间的浮点数（无法解析时记为0）"""
+        validated = []
+        for item in knowledge_list:
+            if not isinstance(item, dict) or not item.get("content"):
+                continue
+            try:
+                confidence = float(item.get("confidence", 0.8))
+            except (TypeError, ValueError):
+                confidence = 0.0
+            if confidence != confidence:  # NaN
+                confidence = 0.0
+            validated.append({
+                "category": str(item.get("category") or "其他"),
+                "content": str(item["content"]),
+                "confidence": min(max(confidence, 0.0), 1.0)
+            })
+        return validated
     
     def _format_conversation(self, messages: List[BaseMessage]) -> str:
-        """格式化对话历史为文本
+        """格式化对话历史为文本（压缩助手回答，跳过重复的问答）
         
         Args:
             messages: 消息列表
-            
+        
         Returns:
             格式化的对话文本
         """
-        lines = []
+        entries = []
         for msg in messages:
-            if isinstance(msg, HumanMessage):
-                lines.append(f"用户: {msg.content}")
-            elif isinstance(msg, AIMessage):
-                lines.append(f"助手: {msg.content}")
+            prefix = ROLE_PREFIXES.get(type(msg))
+            if prefix is not None:
+                content = _compact(str(msg.content)) if type(msg) is AIMessage else msg.content
+                entries.append((type(msg), f"{prefix}{content}"))
+        
+        # 完全相同的一问一答（如反复问候）只保留第一次出现的；没有回答的提问不参与去重
+        seen = set()
+        lines = []
+        i = 0
+        while i < len(entries):
+            msg_type, line = entries[i]
+            if msg_type is HumanMessage and i + 1 < len(entries) and entries[i + 1][0] is AIMessage:
+                pair = (line, entries[i + 1][1])
+                if pair not in seen:
+                    seen.add(pair)
+                    lines.extend(pair)
+                i += 2
+                continue
+            lines.append(line)
+            i += 1
         
         return "\n".join(lines)
     
-    def should_extract(self, messages: List[BaseMessage], threshold: int = 6) -> bool:
+    @staticmethod
+    def _content_hash(message: BaseMessage) -> str:
+        """计算消息内容的哈希"""
+        return hashlib.sha256(str(message.content).encode("utf-8")).hexdigest()
+    
+    def _record_extraction(self, messages: List[BaseMessage], user_id: str):
+        """记录用户本次成功提取时的对话状态"""
+        if not messages:
+            return
+        with self._lock:
+            self._last_extracted[user_id] = (len(messages), self._content_hash(messages[-1]))
+            self._last_extracted.move_to_end(user_id)
+            while len(self._last_extracted) > self.MAX_TRACKED_USERS:
+                self._last_extracted.popitem(last=False)
+    
+    def should_extract(self, messages: List[BaseMessage], threshold: int = 6,
+                       user_id: Optional[str] = None, delta: int = 4) -> bool:
         """判断是否应该提取记忆
         
+        指定user_id时，距上次成功提取新增的消息不足delta条，或最后一条消息与上次相同，则跳过提取。
+        
         Args:
             messages: 消息列表
             threshold: 消息数量阈值
-            
+            user_id: 用户ID
+            delta: 距上次提取至少新增的消息数
+        
         Returns:
             是否应该提取
         """
         # 至少需要一定数量的对话才提取
-        return len(messages) >= threshold
-
+        if len(messages) < threshold:
+            return False
+        if user_id is None:
+            return True
+        
+        with self._lock:
+            last = self._last_extracted.get(user_id)
+        if last is None:
+            return True
+        
+        last_count, last_hash = last
+        # 消息数比上次少说明是新会话，重新开始计数
+        if len(messages) < last_count:
+            return True
+        return len(messages) - last_count >= delta and self._content_hash(messages[-1]) != last_hash
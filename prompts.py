@@ -4,6 +4,14 @@ NL2SQL提示词模板
 定义系统提示词和Few-shot示例。
 """
 
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Tuple
+
+import orjson
+
+from token_counter import truncate_tokens
+
 SYSTEM_PROMPT = """你是一个SQL查询专家，负责将用户的自然语言问题转换为准确的SQL查询语句。
 
 数据库Schema如下：
@@ -19,38 +27,87 @@ SYSTEM_PROMPT = """你是一个SQL查询专家，负责将用户的自然语言
 直接返回SQL语句，不需要解释。"""
 
 
-NL2SQL_EXAMPLES = [
-    {
-        "question": "平均工资最高的部门是哪个？",
-        "sql": """SELECT d.dept_name, AVG(s.base_salary + s.bonus) as avg_salary
+@dataclass(frozen=True, slots=True)
+class NL2SQLExample:
+    """Few-shot示例：问题及对应的SQL"""
+    question: str
+    sql: str
+
+
+NL2SQL_EXAMPLES: Tuple[NL2SQLExample, ...] = (
+    NL2SQLExample(
+        question="平均工资最高的部门是哪个？",
+        sql="""SELECT d.dept_name, AVG(s.base_salary + s.bonus) as avg_salary
 FROM departments d
 JOIN employees e ON d.dept_id = e.dept_id
 JOIN salaries s ON e.emp_id = s.emp_id
 GROUP BY d.dept_id, d.dept_name
 ORDER BY avg_salary DESC
 LIMIT 1"""
-    },
-    {
-        "question": "工资超过10000的员工有几个？",
-        "sql": """SELECT COUNT(*) as high_salary_count
+    ),
+    NL2SQLExample(
+        question="工资超过10000的员工有几个？",
+        sql="""SELECT COUNT(*) as high_salary_count
 FROM salaries
 WHERE base_salary + bonus > 10000"""
-    },
-    {
-        "question": "研发部工资最高的3个人是谁？",
-        "sql": """SELECT e.emp_name, e.position, (s.base_salary + s.bonus) as total_salary
+    ),
+    NL2SQLExample(
+        question="研发部工资最高的3个人是谁？",
+        sql="""SELECT e.emp_name, e.position, (s.base_salary + s.bonus) as total_salary
 FROM employees e
 JOIN departments d ON e.dept_id = d.dept_id
 JOIN salaries s ON e.emp_id = s.emp_id
 WHERE d.dept_name = '研发部'
 ORDER BY total_salary DESC
 LIMIT 3"""
-    }
-]
+    )
+)
 
+# 拼入提示词的可变内容的token上限，避免超出模型上下文
+MAX_DATA_TOKENS = 4000
+MAX_SUMMARY_TOKENS = 1000
+MAX_HISTORY_TOKENS = 1500
 
-def get_few_shot_prompt(question: str, schema: str, num_examples: int = 3) -> str:
-    """构建Few-shot提示词
+
+def _dumps(data: Any) -> str:
+    """将查询结果等数据序列化为JSON文本（已是字符串时原样返回）"""
+    if isinstance(data, str):
+        return data
+    return orjson.dumps(data, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def _render_examples(examples: Tuple[NL2SQLExample, ...]) -> str:
+    """渲染Few-shot示例文本"""
+    return "".join(f"\n问题：{example.question}\n{example.sql}\n" for example in examples)
+
+
+# 各示例数量对应的示例文本（模块加载时预先渲染）
+_EXAMPLES_CACHE = {n: _render_examples(NL2SQL_EXAMPLES[:n]) for n in range(len(NL2SQL_EXAMPLES) + 1)}
+
+
+@lru_cache(maxsize=32)
+def _render_few_shot_prefix(schema: str, num_examples: int) -> str:
+    """渲染Few-shot提示词的稳定前缀（同一Schema和示例数量只渲染一次）
+    
+    Schema首尾空白统一去掉，"问题："标签也放进前缀，保证前缀字节在各次调用间完全一致。
+    """
+    examples_text = _EXAMPLES_CACHE.get(num_examples)
+    if examples_text is None:
+        examples_text = _render_examples(NL2SQL_EXAMPLES[:num_examples])
+    
+    return f"""{SYSTEM_PROMPT.format(schema=schema.strip())}
+
+以下是一些示例：
+{examples_text}
+现在请为以下问题生成SQL（只返回SQL语句，不要任何前缀）：
+问题："""
+
+
+def get_few_shot_parts(question: str, schema: str, num_examples: int = 3) -> Tuple[str, str]:
+    """构建Few-shot提示词，拆分为稳定前缀和问题部分
+    
+    前缀（系统说明 + Schema + 示例 + 输出要求 + "问题："标签）对同一数据库逐字节不变，只有问题部分随查询变化，
+    模型服务的前缀缓存（如DashScope/OpenAI的上下文缓存）可以复用前缀的预填充结果。
     
     Args:
         question: 用户的自然语言问题
@@ -58,21 +115,24 @@ def get_few_shot_prompt(question: str, schema: str, num_examples: int = 3) -> st
         num_examples: 使用的示例数量
     
     Returns:
-        完整的提示词
+        (稳定前缀, 问题部分)
     """
-    examples_text = ""
-    for example in NL2SQL_EXAMPLES[:num_examples]:
-        examples_text += f"\n问题：{example['question']}\n{example['sql']}\n"
-    
-    prompt = f"""{SYSTEM_PROMPT.format(schema=schema)}
+    return _render_few_shot_prefix(schema, num_examples), f"{question}\n"
 
-以下是一些示例：
-{examples_text}
-现在请为以下问题生成SQL（只返回SQL语句，不要任何前缀）：
-问题：{question}
-"""
+
+def get_few_shot_prompt(question: str, schema: str, num_examples: int = 3) -> str:
+    """构建Few-shot提示词
+    
+    Args:
+        question: 用户的自然语言问题
+        schema: 数据库表结构描述
+        num_examples: 使用的示例数量
     
-    return prompt
+    Returns:
+        完整的提示词（稳定前缀在前，问题在最后）
+    """
+    prefix, question_part = get_few_shot_parts(question, schema, num_examples)
+    return prefix + question_part
 
 
 def get_intent_prompt(question: str) -> str:
@@ -94,24 +154,47 @@ def get_intent_prompt(question: str) -> str:
 只返回"需要查询"或"无需查询"，不要有其他内容。"""
 
 
-def get_response_format_prompt(question: str, query_result: str) -> str:
+# 查询结果回答模板：静态说明作为稳定前缀，问题和结果放在后面
+_RESPONSE_FORMAT_TEMPLATE = """请根据查询结果回答用户的问题。
+请用自然语言简洁地回答用户的问题，不要显示原始的JSON数据。如果结果为空，请友好地告知用户。
+
+用户问题：{question}
+
+查询结果：
+{query_result}"""
+
+
+def get_response_format_prompt(question: str, query_result: Any) -> str:
     """格式化查询结果的提示词
     
     Args:
         question: 原始问题
-        query_result: SQL查询结果
+        query_result: SQL查询结果（JSON文本或可序列化的数据）
     
     Returns:
         格式化提示词
     """
-    return f"""请根据查询结果回答用户的问题。
+    return _RESPONSE_FORMAT_TEMPLATE.format(
+        question=question,
+        query_result=truncate_tokens(_dumps(query_result), MAX_DATA_TOKENS)
+    )
 
-用户问题：{question}
 
-查询结果：
-{query_result}
+# 意图识别模板：静态说明放在前面，变量部分放在后面，保证不同请求的prompt前缀完全一致，
+# 便于模型服务端复用前缀缓存
+_MASTER_INTENT_TEMPLATE = """你是一个智能任务路由器，需要分析用户的问题并决定如何处理。
 
-请用自然语言简洁地回答用户的问题，不要显示原始的JSON数据。如果结果为空，请友好地告知用户。"""
+请判断用户的问题属于以下哪一类：
+
+1. simple_answer - 简单问候、感谢或与业务无关的问题（如：你好、谢谢、再见）
+2. sql_only - 需要查询数据库但不需要深度分析（如：有多少员工、张三的工资是多少）
+3. analysis_only - 只需要分析已有数据，不需要新查询（如：分析一下刚才的结果、帮我总结一下之前的数据）
+4. sql_and_analysis - 需要先查询数据再进行深度分析（如：分析各部门薪资水平、找出工资异常的员工并分析原因）
+{history_context}{user_section}
+当前问题：{question}
+
+以JSON格式返回（只返回JSON，不要返回任何解释）：{{"intent": "<选项>"}}
+其中<选项>只能是以下四个之一：simple_answer、sql_only、analysis_only、sql_and_analysis"""
 
 
 def get_master_intent_prompt(question: str, conversation_history: str = "", user_context: str = "") -> str:
@@ -125,75 +208,84 @@ def get_master_intent_prompt(question: str, conversation_history: str = "", user
     Returns:
         意图识别提示词
     """
-    history_context = f"\n对话历史：\n{conversation_history}\n" if conversation_history else ""
-    user_section = f"\n用户信息：\n{user_context}\n" if user_context else ""
-    
-    return f"""你是一个智能任务路由器，需要分析用户的问题并决定如何处理。{history_context}{user_section}
-当前问题：{question}
+    return _MASTER_INTENT_TEMPLATE.format(
+        history_context=(
+            f"\n对话历史：\n{truncate_tokens(conversation_history, MAX_HISTORY_TOKENS, keep_tail=True)}\n"
+            if conversation_history else ""
+        ),
+        user_section=f"\n用户信息：\n{user_context}\n" if user_context else "",
+        question=question
+    )
 
-请判断这个问题属于以下哪一类：
 
-1. simple_answer - 简单问候、感谢或与业务无关的问题（如：你好、谢谢、再见）
-2. sql_only - 需要查询数据库但不需要深度分析（如：有多少员工、张三的工资是多少）
-3. analysis_only - 只需要分析已有数据，不需要新查询（如：分析一下刚才的结果、帮我总结一下之前的数据）
-4. sql_and_analysis - 需要先查询数据再进行深度分析（如：分析各部门薪资水平、找出工资异常的员工并分析原因）
+# 数据分析模板：分析要求作为稳定前缀，问题背景和数据放在后面
+_ANALYSIS_TEMPLATE = """你是一个专业的数据分析师，请对以下数据进行深度分析。
 
-只返回以下四个选项之一：simple_answer、sql_only、analysis_only、sql_and_analysis
-不要返回任何解释，只返回选项本身。"""
+请提供以下分析：
+1. 数据概览：简要描述数据的整体情况
+2. 关键发现：指出数据中最重要的3-5个发现
+3. 趋势分析：如果数据中有趋势或模式，请指出
+4. 异常检测：是否有异常值或不寻常的数据点
+5. 洞察建议：基于数据提供的建议或行动项
+
+请用清晰、专业但易懂的语言回答，突出重点。
+{context_section}
+数据摘要：
+{data_summary}
+
+原始数据：
+{raw_data}"""
 
 
-def get_analysis_prompt(data_summary: str, raw_data: str, context: str = "") -> str:
+def get_analysis_prompt(data_summary: str, raw_data: Any, context: str = "") -> str:
     """数据分析的提示词
     
     Args:
         data_summary: 数据摘要
-        raw_data: 原始数据JSON
+        raw_data: 原始数据（JSON文本或可序列化的数据）
         context: 上下文信息
     
     Returns:
         数据分析提示词
     """
-    context_text = f"\n问题背景：{context}\n" if context else ""
-    
-    return f"""你是一个专业的数据分析师，请对以下数据进行深度分析。{context_text}
-数据摘要：
-{data_summary}
+    return _ANALYSIS_TEMPLATE.format(
+        context_section=f"\n问题背景：{context}\n" if context else "",
+        data_summary=truncate_tokens(data_summary, MAX_SUMMARY_TOKENS),
+        raw_data=truncate_tokens(_dumps(raw_data), MAX_DATA_TOKENS)
+    )
 
-原始数据：
-{raw_data}
 
-请提供以下分析：
-1. 数据概览：简要描述数据的整体情况
-2. 关键发现：指出数据中最重要的3-5个发现
-3. 趋势分析：如果数据中有趋势或模式，请指出
-4. 异常检测：是否有异常值或不寻常的数据点
-5. 洞察建议：基于数据提供的建议或行动项
+# 结果汇总模板：静态说明作为稳定前缀，问题和结果放在后面
+_SUMMARY_TEMPLATE = """请根据以下信息，为用户的问题提供一个完整、清晰的回答。
 
-请用清晰、专业但易懂的语言回答，突出重点。"""
+请综合以下信息，用自然、友好的语言回答用户的问题。确保回答：
+1. 直接针对用户的问题
+2. 包含关键数据和分析洞察
+3. 结构清晰、易于理解
+4. 如果有多个要点，使用列表或分段展示
+
+不要重复显示原始JSON数据，而是用自然语言表达。
+
+用户问题：{question}{sql_section}{analysis_section}"""
 
 
-def get_summary_prompt(question: str, sql_result: str, analysis_result: str) -> str:
+def get_summary_prompt(question: str, sql_result: Any, analysis_result: str) -> str:
     """多智能体结果汇总的提示词
     
     Args:
         question: 用户原始问题
-        sql_result: SQL查询结果
+        sql_result: SQL查询结果（JSON文本或可序列化的数据）
         analysis_result: 分析结果
     
     Returns:
         结果汇总提示词
     """
-    sql_section = f"\n查询结果：\n{sql_result}\n" if sql_result else ""
-    analysis_section = f"\n分析结果：\n{analysis_result}\n" if analysis_result else ""
-    
-    return f"""请根据以下信息，为用户的问题提供一个完整、清晰的回答。
-
-用户问题：{question}{sql_section}{analysis_section}
-
-请综合以上信息，用自然、友好的语言回答用户的问题。确保回答：
-1. 直接针对用户的问题
-2. 包含关键数据和分析洞察
-3. 结构清晰、易于理解
-4. 如果有多个要点，使用列表或分段展示
-
-不要重复显示原始JSON数据，而是用自然语言表达。"""
\ No newline at end of file
+    return _SUMMARY_TEMPLATE.format(
+        question=question,
+        # 先判断原始值：没有查询结果（None）时不输出该段，而不是序列化成"null"
+        sql_section=(
+            f"\n查询结果：\n{truncate_tokens(_dumps(sql_result), MAX_DATA_TOKENS)}\n"
+            if sql_result else ""
+        ),
+        analysis_section=f"\n分析结果：\n{analysis_result}\n" if analysis_result else ""
+    )
@@ -48,5 +48,10 @@ echo "按 Ctrl+C 停止服务器"
 echo "====================================="
 echo
 
+# 已安装gunicorn时使用生产级WSGI服务器（单进程多线程，用户会话保存在进程内）
+if command -v gunicorn > /dev/null 2>&1; then
+    exec gunicorn -w 1 -k gthread --threads 8 -b 0.0.0.0:5000 app:app
+fi
+
 python app.py
 
@@ -34,6 +34,51 @@ async function apiCall(endpoint, data = {}) {
     }
 }
 
+// ===== 流式查询 =====
+// 读取 /api/query_stream 的SSE事件，每收到一段回答就以累计文本回调 onDelta
+async function streamQuery(data, onDelta) {
+    const response = await fetch(`${API_BASE_URL}/api/query_stream`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify(data)
+    });
+    
+    if (!response.ok || !response.body) {
+        const result = await response.json().catch(() => ({}));
+        throw new Error(result.error || '请求失败');
+    }
+    
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let answer = '';
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        
+        for (const event of events) {
+            if (!event.startsWith('data: ')) continue;
+            const payload = JSON.parse(event.slice(6));
+            if (payload.error) {
+                throw new Error(payload.error);
+            }
+            if (payload.delta) {
+                answer += payload.delta;
+                onDelta(answer);
+            }
+        }
+    }
+    
+    return answer;
+}
+
 // ===== 登录相关 =====
 async function handleLogin() {
     const userIdInput = document.getElementById('userIdInput');
@@ -181,6 +226,25 @@ function addMessage(text, isUser = false) {
     
     // 保存到历史
     AppState.messageHistory.push({ text, isUser, time: timeStr });
+    
+    return messageDiv;
+}
+
+// 流式回答过程中刷新AI消息内容
+function updateAssistantMessage(messageDiv, text, historyItem) {
+    const bubble = messageDiv.querySelector('.message-bubble');
+    bubble.innerHTML = `<div class="markdown-body">${renderMarkdown(text)}</div>`;
+    
+    if (typeof hljs !== 'undefined') {
+        bubble.querySelectorAll('pre code').forEach(block => {
+            try { hljs.highlightElement(block); } catch (e) {}
+        });
+    }
+    
+    historyItem.text = text;
+    
+    const chatMessages = document.getElementById('chatMessages');
+    chatMessages.scrollTop = chatMessages.scrollHeight;
 }
 
 function addSystemMessage(text) {
@@ -249,18 +313,28 @@ async function handleQuery(question) {
     // 显示加载动画
     showLoading();
     
+    // 流式显示回答：收到第一段时创建消息，之后原地更新
+    let messageDiv = null;
+    let historyItem = null;
+    
     try {
-        const result = await apiCall('query', {
+        const answer = await streamQuery({
             user_id: AppState.userId,
             question: question
+        }, (text) => {
+            if (!messageDiv) {
+                hideLoading();
+                messageDiv = addMessage(text, false);
+                historyItem = AppState.messageHistory[AppState.messageHistory.length - 1];
+            } else {
+                updateAssistantMessage(messageDiv, text, historyItem);
+            }
         });
         
         hideLoading();
         
-        if (result.success) {
-            addMessage(result.answer, false);
-        } else {
-            addMessage('抱歉，查询失败：' + (result.error || '未知错误'), false);
+        if (!messageDiv) {
+            addMessage(answer || '抱歉，查询失败：未知错误', false);
         }
     } catch (error) {
         hideLoading();
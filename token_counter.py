@@ -0,0 +1,74 @@
+"""
+Token统计与截断
+
+优先使用 tiktoken 的BPE编码精确计数，未安装或编码文件无法加载时按字符数估算。
+"""
+
+import importlib.util
+from functools import lru_cache
+
+# 分词器可选：未安装 tiktoken 或编码文件无法加载时，按字符数估算token
+HAS_TIKTOKEN = importlib.util.find_spec("tiktoken") is not None
+
+# 估算时平均每个token对应的字符数（中文约2字符=1token，英文约4字符=1token）
+CHARS_PER_TOKEN = 2.5
+
+# 截断处的标记
+TRUNCATION_MARK = "…[已截断]…"
+
+
+@lru_cache(maxsize=1)
+def get_token_encoding():
+    """加载BPE编码（首次使用时加载，失败时返回None）"""
+    if not HAS_TIKTOKEN:
+        return None
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"加载tiktoken编码失败，改用字符数估算: {e}")
+        return None
+
+
+def _encode(encoding, text: str) -> list:
+    """编码文本；用户输入或查询数据可能包含"<|endoftext|>"等特殊token字面量，按普通文本编码"""
+    return encoding.encode(text, disallowed_special=())
+
+
+def count_tokens(text: str) -> float:
+    """统计文本token数"""
+    encoding = get_token_encoding()
+    if encoding is None:
+        return len(text) / CHARS_PER_TOKEN
+    return len(_encode(encoding, text))
+
+
+def truncate_tokens(text: str, max_tokens: int, keep_tail: bool = False) -> str:
+    """将文本截断到指定token数以内
+    
+    Args:
+        text: 原始文本
+        max_tokens: 最大token数
+        keep_tail: 是否保留结尾部分（如对话历史保留最近的内容），默认保留开头
+    
+    Returns:
+        截断后的文本，未超出时原样返回
+    """
+    encoding = get_token_encoding()
+    if encoding is None:
+        max_chars = int(max_tokens * CHARS_PER_TOKEN)
+        if len(text) <= max_chars:
+            return text
+        return TRUNCATION_MARK + text[-max_chars:] if keep_tail else text[:max_chars] + TRUNCATION_MARK
+    
+    # 字符数不超过token上限时一定不会超出，省去一次编码
+    if len(text) <= max_tokens:
+        return text
+    tokens = _encode(encoding, text)
+    if len(tokens) <= max_tokens:
+        return text
+    
+    # 切分处可能落在多字节字符中间，去掉解码产生的替换字符
+    if keep_tail:
+        return TRUNCATION_MARK + encoding.decode(tokens[-max_tokens:]).lstrip("�")
+    return encoding.decode(tokens[:max_tokens]).rstrip("�") + TRUNCATION_MARK